@@ -0,0 +1,173 @@
+import os
+import mmap
+import struct
+import zlib
+import subprocess
+import threading
+
+###################################################################################################
+# CONSTANTS
+###################################################################################################
+APP_PATH      = os.path.dirname(os.path.abspath(__file__))
+PACK_FILE     = APP_PATH + "/osd_assets.pack"
+PACK_MAGIC    = "RCPK"
+PACK_VERSION  = 1
+PACK_ALIGN    = 16
+
+# header : magic, version, count
+# entry  : name, width, height, offset, size, adler32 of framed rows, crc32 of IDAT chunk
+HEADER_FORMAT = "<4sHH"
+ENTRY_FORMAT  = "<32sHHIIII"
+HEADER_SIZE   = struct.calcsize(HEADER_FORMAT)
+ENTRY_SIZE    = struct.calcsize(ENTRY_FORMAT)
+
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+
+###################################################################################################
+# PNG FRAMING
+###################################################################################################
+def _chunk(tag, data):
+    crc = zlib.crc32(tag + data) & 0xffffffff
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", crc)
+
+def frameRows(width, height, pixels):
+    """Yield the zlib stream of an RGBA image as uncompressed (stored) deflate blocks.
+    One block per row : block header, filter byte 0 and a slice of the pixel buffer.
+    """
+    stride = width * 4
+    yield "\x78\x01"
+    for y in range(height):
+        size  = stride + 1
+        final = 1 if y == height - 1 else 0
+        yield struct.pack("<BHH", final, size, size ^ 0xffff) + "\x00"
+        yield buffer(pixels, y * stride, stride)
+
+def idatSize(width, height):
+    return 2 + height * (6 + width * 4) + 4
+
+def rowsAdler(width, height, pixels):
+    adler  = 1
+    stride = width * 4
+    for y in range(height):
+        adler = zlib.adler32("\x00", adler)
+        adler = zlib.adler32(buffer(pixels, y * stride, stride), adler)
+    return adler & 0xffffffff
+
+def idatCRC(width, height, pixels, adler):
+    crc = zlib.crc32("IDAT")
+    for part in frameRows(width, height, pixels):
+        crc = zlib.crc32(part, crc)
+    crc = zlib.crc32(struct.pack(">I", adler), crc)
+    return crc & 0xffffffff
+
+
+###################################################################################################
+# ASSET PACK CLASS
+###################################################################################################
+class AssetPack(object):
+    def __init__(self, path = PACK_FILE):
+        self._index = {}
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self._map = mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        (magic, version, count) = struct.unpack_from(HEADER_FORMAT, self._map, 0)
+        if magic != PACK_MAGIC or version != PACK_VERSION:
+            self._map.close()
+            raise ValueError("invalid asset pack : " + path)
+
+        pos = HEADER_SIZE
+        for i in range(count):
+            (name, width, height, offset, size, adler, crc) = struct.unpack_from(ENTRY_FORMAT, self._map, pos)
+            self._index[name.rstrip("\x00")] = (width, height, offset, size, adler, crc)
+            pos += ENTRY_SIZE
+
+    def close(self):
+        self._index = {}
+        self._map.close()
+
+    def has(self, name):
+        return name in self._index
+
+    def image(self, name):
+        """Return (width, height, pixels) where pixels is a zero-copy RGBA view into the pack"""
+        (width, height, offset, size, adler, crc) = self._index[name]
+        return width, height, buffer(self._map, offset, size)
+
+    def writePNG(self, fd, name):
+        """Stream the image as an uncompressed PNG to fd without copying the pixel data"""
+        (width, height, offset, size, adler, crc) = self._index[name]
+        writeRGBA(fd, width, height, buffer(self._map, offset, size), adler, crc)
+
+
+def writeRGBA(fd, width, height, pixels, adler = None, crc = None):
+    """Stream RGBA pixels as an uncompressed PNG, checksums are computed if not given"""
+    if adler == None:
+        adler = rowsAdler(width, height, pixels)
+        crc   = idatCRC(width, height, pixels, adler)
+
+    _writeAll(fd, PNG_SIGNATURE + _chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+    _writeAll(fd, struct.pack(">I", idatSize(width, height)) + "IDAT")
+    for part in frameRows(width, height, pixels):
+        _writeAll(fd, part)
+    _writeAll(fd, struct.pack(">II", adler, crc) + _chunk("IEND", ""))
+
+def _writeAll(fd, data):
+    offset = 0
+    while offset < len(data):
+        offset += os.write(fd, buffer(data, offset))
+
+
+###################################################################################################
+# PNGVIEW HELPER
+###################################################################################################
+_pack = None
+_packChecked = False
+
+def getPack():
+    global _pack, _packChecked
+
+    if not _packChecked:
+        _packChecked = True
+        try:
+            _pack = AssetPack()
+        except (OSError, IOError, ValueError, mmap.error):
+            _pack = None
+    return _pack
+
+def showImage(name, args):
+    """Launch pngview for the named asset, fed from the pack through stdin when available.
+    Falls back to the PNG file in APP_PATH if the pack is missing or lacks the image.
+    """
+    pack = getPack()
+    if pack == None or not pack.has(name):
+        return subprocess.Popen([APP_PATH + "/pngview"] + args + [APP_PATH + "/" + name + ".png"])
+
+    proc = subprocess.Popen([APP_PATH + "/pngview"] + args + ["-"], stdin = subprocess.PIPE)
+    _startFeeder(proc, lambda fd: pack.writePNG(fd, name))
+    return proc
+
+def showPixels(width, height, pixels, args):
+    """Launch pngview for an RGBA image rendered at runtime"""
+    proc = subprocess.Popen([APP_PATH + "/pngview"] + args + ["-"], stdin = subprocess.PIPE)
+    _startFeeder(proc, lambda fd: writeRGBA(fd, width, height, pixels))
+    return proc
+
+def _feed(proc, write):
+    # a terminated pngview breaks the pipe, nothing left to feed then
+    try:
+        write(proc.stdin.fileno())
+    except (OSError, IOError, ValueError):
+        pass
+    try:
+        proc.stdin.close()
+    except IOError:
+        pass
+
+def _startFeeder(proc, write):
+    # the pipe blocks until pngview has started and read the image, keep it off the main loop
+    feeder = threading.Thread(target = _feed, args = (proc, write))
+    feeder.setDaemon(True)
+    feeder.start()
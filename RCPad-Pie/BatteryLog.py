@@ -0,0 +1,235 @@
+import os
+import array
+import bisect
+import threading
+
+###################################################################################################
+# CONSTANTS
+###################################################################################################
+APP_PATH      = os.path.dirname(os.path.abspath(__file__))
+LOG_FILE      = APP_PATH + "/battery.log"
+CURVE_FILE    = APP_PATH + "/battery_curve.conf"
+
+# a record is 2 x uint32 : timestamp, adc | charging << 16
+RECORD_WORDS  = 2
+FLUSH_RECORDS = 300                 # 10 min of 2 sec samples per SD write
+FLUSH_LOW     = 15                  # 30 sec once the battery runs low, a brownout loses little
+MAX_RECORDS   = 262144              # 2 MB, older half is dropped when full
+
+# discharge cycle detection
+CYCLE_MAX_GAP = 60                  # sec, longer gaps (power off, clock jump) end a cycle
+CYCLE_MIN_LEN = 1800                # sec
+SMOOTH_WINDOW = 20                  # samples, same as the live voltage window
+CURVE_STEP    = 5                   # percent
+
+
+###################################################################################################
+# BATTERY LOG CLASS
+###################################################################################################
+class BatteryLog(object):
+    def __init__(self, path = LOG_FILE, maxRecords = MAX_RECORDS, flushRecords = FLUSH_RECORDS):
+        self._path         = path
+        self._maxRecords   = maxRecords
+        self._flushRecords = flushRecords
+        self._pending      = array.array('I')
+        self._lock         = threading.RLock()           # MSP thread appends, main loop may flush
+        try:
+            self._count = os.path.getsize(path) / (RECORD_WORDS * self._pending.itemsize)
+        except OSError:
+            self._count = 0
+
+    def setFlushRecords(self, flushRecords):
+        self._flushRecords = flushRecords
+
+    def append(self, ts, adc, charging):
+        with self._lock:
+            self._pending.append(int(ts))
+            self._pending.append((adc & 0xffff) | (0x10000 if charging else 0))
+            if len(self._pending) >= self._flushRecords * RECORD_WORDS:
+                self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+
+        if self._count + len(self._pending) / RECORD_WORDS > self._maxRecords:
+            self._compact()
+
+        try:
+            with open(self._path, "ab") as f:
+                self._pending.tofile(f)
+            self._count += len(self._pending) / RECORD_WORDS
+        except IOError, e:
+            print "battery log write error: " + str(e)
+        self._pending = array.array('I')
+
+    def _compact(self):
+        # keep the newer half of the log
+        data = self.read(False)
+        keep = data[len(data) - (self._maxRecords / 2) * RECORD_WORDS:] if len(data) > 0 else data
+        try:
+            with open(self._path + ".tmp", "wb") as f:
+                keep.tofile(f)
+            os.rename(self._path + ".tmp", self._path)
+            self._count = len(keep) / RECORD_WORDS
+        except (IOError, OSError), e:
+            print "battery log compact error: " + str(e)
+
+    def read(self, withPending = True):
+        """Return all records as a flat array : ts0, word0, ts1, word1, ..."""
+        data = array.array('I')
+        try:
+            with open(self._path, "rb") as f:
+                data.fromstring(f.read())
+        except IOError:
+            pass
+        del data[len(data) - len(data) % RECORD_WORDS:]
+        if withPending:
+            data.extend(self._pending)
+        return data
+
+
+###################################################################################################
+# DISCHARGE CURVE FITTING
+###################################################################################################
+def findCycles(data, adc2volt, voltFull, voltEmpty):
+    """Split records into full discharge cycles : not charging, no long gap,
+    starting above voltFull and running down below voltEmpty.
+    Returns lists of (ts, adc).
+    """
+    cycles = []
+    cycle  = []
+    lastTS = None
+    for i in range(0, len(data), RECORD_WORDS):
+        (ts, word) = (data[i], data[i + 1])
+        charging   = word & 0x10000
+        if charging or lastTS == None or ts < lastTS or ts - lastTS > CYCLE_MAX_GAP:
+            if len(cycle) > 1:
+                cycles.append(cycle)
+            cycle = []
+        if not charging:
+            cycle.append((ts, word & 0xffff))
+        lastTS = ts
+    if len(cycle) > 1:
+        cycles.append(cycle)
+
+    full = []
+    for cycle in cycles:
+        if cycle[-1][0] - cycle[0][0] < CYCLE_MIN_LEN:
+            continue
+        if adc2volt(cycle[0][1]) < voltFull or adc2volt(min(adc for (ts, adc) in cycle)) > voltEmpty:
+            continue
+        full.append(cycle)
+    return full
+
+def _poolAdjacent(points):
+    # weighted isotonic regression, remaining charge must not decrease with adc
+    blocks = []
+    for (adc, value, weight) in points:
+        blocks.append([adc, value, weight])
+        while len(blocks) > 1 and blocks[-2][1] > blocks[-1][1]:
+            (a, b) = (blocks[-2], blocks.pop())
+            a[1] = (a[1] * a[2] + b[1] * b[2]) / (a[2] + b[2])
+            a[2] = a[2] + b[2]
+            a[0] = b[0]
+    return blocks
+
+def fitDischarge(data, adc2volt, voltFull, voltEmpty):
+    """Learn a (percent, volt) table from the full discharge cycles in the log.
+    Returns None if there is no full cycle recorded yet.
+    """
+    cycles = findCycles(data, adc2volt, voltFull, voltEmpty)
+    if not cycles:
+        return None
+
+    sums   = {}
+    counts = {}
+    for cycle in cycles:
+        (start, end) = (cycle[0][0], cycle[-1][0])
+        window = []
+        for (ts, adc) in cycle:
+            window.append(adc)
+            if len(window) > SMOOTH_WINDOW:
+                window.pop(0)
+            key = int(round(float(sum(window)) / len(window)))
+            sums[key]   = sums.get(key, 0.0) + 100.0 * (end - ts) / (end - start)
+            counts[key] = counts.get(key, 0) + 1
+
+    blocks = _poolAdjacent([(adc, sums[adc] / counts[adc], counts[adc]) for adc in sorted(sums)])
+
+    # sample the fitted curve at fixed percent steps
+    values = [b[1] for b in blocks]
+    table  = []
+    for percent in range(0, 101, CURVE_STEP):
+        i = bisect.bisect_left(values, percent)
+        if i == 0:
+            adc = blocks[0][0]
+        elif i >= len(blocks):
+            adc = blocks[-1][0]
+        else:
+            (a, b) = (blocks[i - 1], blocks[i])
+            adc = a[0] + (b[0] - a[0]) * (percent - a[1]) / (b[1] - a[1])
+        table.append((percent, adc2volt(adc)))
+    return table
+
+def saveCurve(table, path = CURVE_FILE):
+    with open(path + ".tmp", "w") as f:
+        for (percent, volt) in table:
+            f.write("%d %.4f\n" % (percent, volt))
+    os.rename(path + ".tmp", path)
+
+def loadCurve(path = CURVE_FILE):
+    """Read a learned (percent, volt) table, None if there is none"""
+    table = []
+    try:
+        with open(path) as f:
+            for line in f:
+                items = line.split()
+                if len(items) == 2:
+                    table.append((int(items[0]), float(items[1])))
+    except (IOError, ValueError):
+        return None
+    table.sort()
+    return table if len(table) > 1 else None
+
+def curvePercent(table, volt):
+    """Interpolate the remaining charge in percent for a voltage"""
+    volts = [v for (p, v) in table]
+    i = bisect.bisect_left(volts, volt)
+    if i == 0:
+        return table[0][0]
+    if i >= len(table):
+        return table[-1][0]
+    ((p0, v0), (p1, v1)) = (table[i - 1], table[i])
+    if v1 == v0:
+        return p1
+    return p0 + (p1 - p0) * (volt - v0) / (v1 - v0)
+
+
+###################################################################################################
+# MAIN
+###################################################################################################
+if __name__ == "__main__":
+    import sys
+    import BatteryMonitor
+
+    try:
+        log   = BatteryLog(sys.argv[1] if len(sys.argv) > 1 else LOG_FILE)
+        data  = log.read()
+        table = fitDischarge(data, BatteryMonitor.adc2volt, BatteryMonitor.VOLT_100, BatteryMonitor.VOLT_EMPTY)
+        print("%d records" % (len(data) / RECORD_WORDS))
+        if table == None:
+            print("no full discharge cycle recorded")
+        else:
+            for (percent, volt) in table:
+                print("%3d%% %.3fV" % (percent, volt))
+            saveCurve(table)
+
+    # Catch all other non-exit errors
+    except Exception as e:
+        sys.stderr.write("Unexpected exception: %s" % e)
+        sys.exit(1)
@@ -17,13 +17,14 @@ import serial
 import threading
 import struct
 import signal
-import subprocess
 import time
-import array
 import os
-import signal
-import subprocess
-import math
+import errno
+import fcntl
+import select
+import collections
+import AssetPack
+import BatteryLog
 
 ###################################################################################################
 # CONSTANTS
@@ -32,6 +33,8 @@ APP_PATH      = os.path.dirname(os.path.abspath(__file__))
 
 # BATTERY CONFIGURATION
 RATE_BATT_MS  = 2000
+RATE_IDLE_MS  = 100
+TX_QUEUE_MAX  = 16               # encoded frames waiting for the serial port
 R1            = 10000
 R2            =  5100
 VOLT_CHARGING = 8.45
@@ -40,6 +43,13 @@ VOLT_75       = 3.76 * 2
 VOLT_50       = 3.63 * 2
 VOLT_25       = 3.5  * 2
 VOLT_0        = 3.2  * 2
+VOLT_EMPTY    = 3.3  * 2          # a logged discharge below this counts as a full cycle
+VOLT_LOG_LOW  = VOLT_25           # flush the battery log more often below this
+
+def adc2volt(adc):
+    vout = adc * 5.0 / 1024.0
+    volt = vout * (R1 + R2) / R2
+    return volt
 
 class COMMANDS:
     NOP              = 0x00
@@ -71,6 +81,24 @@ class MSP(threading.Thread):
         self._exitNow = threading.Event()
         self._responses = {}
         self.responseTimeout = 3
+        self.idleSleep = RATE_IDLE_MS / 1000.0
+
+        # transmit ring drained by the MSP thread, callers never write to the port
+        self._txLock     = threading.Lock()
+        self._txQueue    = collections.deque()
+        self._txPending  = set()
+        self._txOffset   = 0
+        self._inFlight   = {}           # command : host time it was queued, until its reply or responseTimeout
+        self.txQueued    = 0
+        self.txCoalesced = 0
+        self.txDropped   = 0
+        self.txMaxDepth  = 0
+        self.onActivity  = None         # callback(kind, host ms) on frames sent / received
+
+        # self-pipe waking the MSP thread out of select() when a frame is queued
+        (self._wakeR, self._wakeW) = os.pipe()
+        for wfd in (self._wakeR, self._wakeW):
+            fcntl.fcntl(wfd, fcntl.F_SETFL, fcntl.fcntl(wfd, fcntl.F_GETFL) | os.O_NONBLOCK)
 
     def run(self):
         state        = self._MSPSTATES.IDLE
@@ -79,6 +107,9 @@ class MSP(threading.Thread):
         dataChecksum = 0
         command      = 0
 
+        fd = self._port.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
         while (not self._exitNow.isSet()):
             if (self._port.inWaiting() > 0):
                 inByte = ord(self._port.read())
@@ -104,20 +135,76 @@ class MSP(threading.Thread):
                     if (dataChecksum == inByte):
                         #Good command, do something with it
                         #self._processCommand(command, data)
+                        self._replied(command)
                         self.commandRecceived(command, data) #Call the subclass method
+                        self._markActivity("msp-rx")
                     else:
                         #Bad checksum
                         pass
                     state = self._MSPSTATES.IDLE
+
+                # a steady RX stream must not starve TX, the write is non-blocking
+                if self._txQueue:
+                    self._drainTX(fd)
             else:
-                time.sleep(0.1)
+                wfds = [fd] if self._txQueue else []
+                try:
+                    (rfds, wfds, xfds) = select.select([fd, self._wakeR], wfds, [], self.idleSleep)
+                except select.error:
+                    continue
+                if self._wakeR in rfds:
+                    try:
+                        os.read(self._wakeR, 256)
+                    except OSError:
+                        pass
+                if wfds:
+                    self._drainTX(fd)
 
         print("MSP thread finished")
 
+    def _drainTX(self, fd):
+        with self._txLock:
+            while self._txQueue:
+                frame = self._txQueue[0]
+                try:
+                    self._txOffset += os.write(fd, frame[self._txOffset:])
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        print "serial port write error: " + str(e)
+                        self._txQueue.popleft()
+                        self._txPending.discard(frame)
+                        self._txOffset = 0
+                    return
+                if self._txOffset < len(frame):
+                    return
+                self._txQueue.popleft()
+                self._txPending.discard(frame)
+                self._txOffset = 0
+                self._markActivity("msp-tx")
+
+    def _markActivity(self, kind):
+        if self.onActivity != None:
+            self.onActivity(kind, int(round(time.time() * 1000)))
+
+    def _wake(self):
+        if self._wakeW == None:
+            return
+        try:
+            os.write(self._wakeW, "w")
+        except OSError:
+            pass                        # pipe full, a wakeup is already pending
+
     def _stop(self):
         self._exitNow.set()
-        self.join()
-        self._port.close()
+        self._wake()
+        if self.isAlive():
+            self.join()
+        if self._port != None:
+            self._port.close()
+        if self._wakeW != None:
+            os.close(self._wakeR)
+            os.close(self._wakeW)
+            self._wakeR = self._wakeW = None
 
     def __del__(self):
         self._stop()
@@ -195,14 +282,39 @@ class MSP(threading.Thread):
                 output.append(b)
                 checksum = (checksum ^ b)
         output.append(checksum)
-        try:
-            size = self._port.write(output)
-            self._responses.update({command: self._MSPResponse()})
-        except Exception, e:
-            print "serial port write error: " + str(e)
-            return False
+        return self._queueFrame(command, str(output))
+
+    def _queueFrame(self, command, frame):
+        """Queue an encoded frame for the MSP thread. Identical frames still waiting and
+        commands still waiting for their reply are coalesced, a full queue rejects the frame (returns False).
+        """
+        now = time.time()
+        with self._txLock:
+            sent = self._inFlight.get(command)
+            if frame in self._txPending or (sent != None and now - sent < self.responseTimeout):
+                self.txCoalesced += 1
+                return True
+            if len(self._txQueue) >= TX_QUEUE_MAX:
+                self.txDropped += 1
+                return False
+            self._txQueue.append(frame)
+            self._txPending.add(frame)
+            self._inFlight[command] = now
+            self.txQueued  += 1
+            self.txMaxDepth = max(self.txMaxDepth, len(self._txQueue))
+        self._wake()
+        self._responses.update({command: self._MSPResponse()})
         return True
 
+    def _replied(self, command):
+        with self._txLock:
+            self._inFlight.pop(command, None)
+
+    def getTXStats(self):
+        """Return (depth, queued, coalesced, dropped, max depth) of the transmit queue"""
+        with self._txLock:
+            return len(self._txQueue), self.txQueued, self.txCoalesced, self.txDropped, self.txMaxDepth
+
     def _waitForResponse(self, command):
         if (self._responses.has_key(command)):
             startTime = time.time()
@@ -255,7 +367,8 @@ class MSP(threading.Thread):
 ###################################################################################################
 class SubMSP(MSP):
     def __init__(self, port):
-        super(SubMSP, self).__init__(serial.Serial(port, 115200, writeTimeout = 0.1))
+        super(SubMSP, self).__init__(None)
+        self._portName   = port
         self._tblCommand = {
             0x00 : self._nop,
             0x01 : self._handleBattery
@@ -265,9 +378,25 @@ class SubMSP(MSP):
         self._listVolts  = []
         self._isCharging = False
         self._lastBattTS = 0
+        self._log        = BatteryLog.BatteryLog()
+        self._curve      = BatteryLog.loadCurve()     # learned (percent, volt) table
+        self._fitting    = threading.Event()
+        self.percent     = None                       # remaining charge estimate
+        self.volt        = None                       # windowed average voltage
+        self._rateBatt   = RATE_BATT_MS
+
+    def run(self):
+        # the port is opened in the MSP thread not to hold up the startup of the main loop
+        try:
+            self._port = serial.Serial(self._portName, 115200, writeTimeout = 0.1)
+        except serial.SerialException, e:
+            print "serial port open error: " + str(e)
+            return
+        super(SubMSP, self).run()
 
     def stop(self):
         super(SubMSP, self).stop()
+        self._log.flush()
         if self._procOSD != None:
             self._procOSD.terminate()
             self._procOSD.wait()
@@ -281,9 +410,7 @@ class SubMSP(MSP):
         return adc
 
     def _adc2volt(self, adc):
-        vout = adc * 5.0 / 1024.0
-        volt = vout * (R1 + R2) / R2
-        return volt
+        return adc2volt(adc)
 
     def _nop(self, data):
         pass
@@ -300,8 +427,7 @@ class SubMSP(MSP):
                 self._procOSD = None
 
             self._curPercent = percent
-            self._procOSD = subprocess.Popen([APP_PATH + "/pngview", "-b0x0000", "-l30000", "-n", "-x768", "-y2",
-                APP_PATH + "/battery_" + percent + ".png"])
+            self._procOSD = AssetPack.showImage("battery_" + percent, ["-b0x0000", "-l30000", "-n", "-x768", "-y2"])
 
             #print "%d" % self._procOSD.pid
 
@@ -311,6 +437,8 @@ class SubMSP(MSP):
 
         # first check charging status change
         if volt > VOLT_CHARGING:
+            if self._isCharging == False:
+                self._learnCurve()
             self._isCharging = True
         elif self._isCharging == True:
             del self._listVolts[:]
@@ -326,11 +454,36 @@ class SubMSP(MSP):
         for v in self._listVolts:
             sum = sum + v
         avg = sum / len(self._listVolts)
+        self.volt = avg
+
+        # the low voltage end is what the curve fit needs, keep it safe from brownouts
+        if self._isCharging == False and avg < VOLT_EMPTY:
+            self._log.setFlushRecords(1)
+        elif self._isCharging == False and avg < VOLT_LOG_LOW:
+            self._log.setFlushRecords(BatteryLog.FLUSH_LOW)
+        else:
+            self._log.setFlushRecords(BatteryLog.FLUSH_RECORDS)
+        self._log.append(time.time(), adc, self._isCharging)
 
         #print "battery => %d %fV (%d) => %fV" % (adc, volt, len(self._listVolts), avg)
 
+        if self._curve != None:
+            self.percent = BatteryLog.curvePercent(self._curve, avg)
+
         if self._isCharging == True:
             self._dispBattery("charging")
+        elif self._curve != None:
+            # nearest quarter of the learned remaining charge
+            if self.percent > 87.5:
+                self._dispBattery("100")
+            elif self.percent > 62.5:
+                self._dispBattery("75")
+            elif self.percent > 37.5:
+                self._dispBattery("50")
+            elif self.percent > 12.5:
+                self._dispBattery("25")
+            else:
+                self._dispBattery("0")
         elif avg > VOLT_100:
             self._dispBattery("100")
         elif avg > VOLT_75:
@@ -342,19 +495,58 @@ class SubMSP(MSP):
         else:
             self._dispBattery("0")
 
+    def _learnCurve(self):
+        # a discharge just ended, refit the curve with it off the MSP thread
+        self._log.flush()
+        if self._fitting.isSet():
+            return
+        self._fitting.set()
+        fitter = threading.Thread(target = self._fitCurve)
+        fitter.setDaemon(True)
+        fitter.start()
+
+    def _fitCurve(self):
+        try:
+            table = BatteryLog.fitDischarge(self._log.read(), adc2volt, VOLT_100, VOLT_EMPTY)
+            if table != None:
+                BatteryLog.saveCurve(table)
+                self._curve = table
+        except (IOError, OSError), e:
+            print "battery curve fit error: " + str(e)
+        self._fitting.clear()
+
+    def flushLog(self):
+        self._log.flush()
+
     def commandRecceived(self, command, data, error=False):
         result = self._tblCommand.get(command, self._nop)
         if result:
             result(data)
 
+    def getBattery(self):
+        """Return (average volt, remaining percent, charging), volt is None before the first sample"""
+        return self.volt, self.percent, self._isCharging
+
+    def setRateScale(self, scale):
+        # stretch battery polling and the serial idle sleep (power saving profiles)
+        self._rateBatt = RATE_BATT_MS * scale
+        self.idleSleep = RATE_IDLE_MS * scale / 1000.0
+
     def process(self, ts):
+        # serial port is not opened yet
+        if self._port == None:
+            return self._rateBatt
+
         # probe battery level
-        if ts - self._lastBattTS > RATE_BATT_MS:
-            self.sendCommand(COMMANDS.GET_BATTERY_ADC)
-            self._lastBattTS = ts
-            left = 0
+        if ts - self._lastBattTS > self._rateBatt:
+            # a full transmit queue rejects the poll, it is tried again on the next pass
+            if self.sendCommand(COMMANDS.GET_BATTERY_ADC):
+                self._lastBattTS = ts
+                left = 0
+            else:
+                left = RATE_IDLE_MS
         else:
-            left = RATE_BATT_MS - (ts - self._lastBattTS)
+            left = self._rateBatt - (ts - self._lastBattTS)
         return left
 
 
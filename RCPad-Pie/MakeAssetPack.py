@@ -0,0 +1,131 @@
+#!/usr/bin/python
+import os
+import glob
+import struct
+import zlib
+import AssetPack
+
+###################################################################################################
+# CONSTANTS
+###################################################################################################
+APP_PATH      = os.path.dirname(os.path.abspath(__file__))
+ASSET_GLOBS   = ["battery_*.png", "volume*.png", "wifi-*.png"]
+
+
+###################################################################################################
+# PNG DECODER (8bit RGB / RGBA, non-interlaced)
+###################################################################################################
+def _paeth(a, b, c):
+    p  = a + b - c
+    pa = abs(p - a)
+    pb = abs(p - b)
+    pc = abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    elif pb <= pc:
+        return b
+    return c
+
+def decodePNG(path):
+    """Decode a PNG file into (width, height, RGBA bytearray)"""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if data[:8] != AssetPack.PNG_SIGNATURE:
+        raise ValueError("not a png : " + path)
+
+    pos  = 8
+    idat = []
+    while pos < len(data):
+        (length, tag) = struct.unpack(">I4s", data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        if tag == "IHDR":
+            (width, height, depth, colorType, comp, filt, interlace) = struct.unpack(">IIBBBBB", body)
+        elif tag == "IDAT":
+            idat.append(body)
+        elif tag == "IEND":
+            break
+        pos += 12 + length
+
+    if depth != 8 or colorType not in (2, 6) or interlace != 0:
+        raise ValueError("unsupported png format : " + path)
+
+    bpp    = 4 if colorType == 6 else 3
+    stride = width * bpp
+    raw    = bytearray(zlib.decompress("".join(idat)))
+    prev   = bytearray(stride)
+    out    = bytearray()
+
+    pos = 0
+    for y in range(height):
+        ftype = raw[pos]
+        line  = raw[pos + 1:pos + 1 + stride]
+        pos  += 1 + stride
+
+        for x in range(stride):
+            a = line[x - bpp] if x >= bpp else 0
+            b = prev[x]
+            c = prev[x - bpp] if x >= bpp else 0
+            if ftype == 1:
+                line[x] = (line[x] + a) & 0xff
+            elif ftype == 2:
+                line[x] = (line[x] + b) & 0xff
+            elif ftype == 3:
+                line[x] = (line[x] + ((a + b) >> 1)) & 0xff
+            elif ftype == 4:
+                line[x] = (line[x] + _paeth(a, b, c)) & 0xff
+
+        if bpp == 4:
+            out += line
+        else:
+            for x in range(0, stride, 3):
+                out += line[x:x + 3] + "\xff"
+        prev = line
+
+    return width, height, out
+
+
+###################################################################################################
+# PACK BUILDER
+###################################################################################################
+def buildPack(files, packPath):
+    images = []
+    for path in files:
+        name = os.path.splitext(os.path.basename(path))[0]
+        (width, height, pixels) = decodePNG(path)
+        images.append((name, width, height, pixels))
+
+    pos     = AssetPack.HEADER_SIZE + AssetPack.ENTRY_SIZE * len(images)
+    entries = []
+    for (name, width, height, pixels) in images:
+        pos   = (pos + AssetPack.PACK_ALIGN - 1) & ~(AssetPack.PACK_ALIGN - 1)
+        adler = AssetPack.rowsAdler(width, height, pixels)
+        crc   = AssetPack.idatCRC(width, height, pixels, adler)
+        entries.append(struct.pack(AssetPack.ENTRY_FORMAT, name, width, height, pos, len(pixels), adler, crc))
+        pos  += len(pixels)
+
+    with open(packPath + ".tmp", "wb") as f:
+        f.write(struct.pack(AssetPack.HEADER_FORMAT, AssetPack.PACK_MAGIC, AssetPack.PACK_VERSION, len(images)))
+        for entry in entries:
+            f.write(entry)
+        for (name, width, height, pixels) in images:
+            f.write("\x00" * (-f.tell() % AssetPack.PACK_ALIGN))
+            f.write(pixels)
+    os.rename(packPath + ".tmp", packPath)
+
+    return len(images)
+
+
+###################################################################################################
+# MAIN
+###################################################################################################
+if __name__ == "__main__":
+    import sys
+
+    packPath = sys.argv[1] if len(sys.argv) > 1 else AssetPack.PACK_FILE
+    files    = []
+    for pattern in ASSET_GLOBS:
+        files += sorted(glob.glob(os.path.join(APP_PATH, pattern)))
+
+    count = buildPack(files, packPath)
+    print("%d images packed into %s" % (count, packPath))
@@ -1,4 +1,5 @@
 import Queue
+import time
 import threading
 import RPi.GPIO as GPIO
 
@@ -16,6 +17,7 @@ class OSD(threading.Thread):
     def __init__(self):
         threading.Thread.__init__(self)
         self._dataQueue = Queue.Queue()
+        self.lcdOn      = True          # assumed on at boot, flipped by every queued 'O' toggle
         GPIO.setup(PIN_LCD_ON_OFF, GPIO.IN)
         GPIO.setup(PIN_RETURN,     GPIO.IN)
         GPIO.setup(PIN_MENU,       GPIO.IN)
@@ -50,6 +52,8 @@ class OSD(threading.Thread):
         print("OSD thread finished")
 
     def queue(self, data):
+        if data == 'O':
+            self.lcdOn = not self.lcdOn
         self._dataQueue.put(data)
         
     def stop(self):
@@ -0,0 +1,293 @@
+import os
+import time
+import signal
+import threading
+import AssetPack
+
+###################################################################################################
+# CONSTANTS
+###################################################################################################
+STAT_FILE      = "/proc/stat"
+TEMP_FILE      = "/sys/class/thermal/thermal_zone0/temp"
+FREQ_FILE      = "/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq"
+FREQ_MAX_FILE  = "/sys/devices/system/cpu/cpu0/cpufreq/cpuinfo_max_freq"
+THROTTLED_FILE = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+
+HUD_BUTTON     = 18                 # default js button toggling the HUD, --hud-button=N overrides
+RATE_HUD_MS    = 1000
+RATE_HUD_MAX_MS= 8000
+HUD_CPU_BUDGET = 0.01               # max share of one core spent on the HUD
+THROTTLE_LOAD  = 0.8                # without get_throttled, capped freq under this load is throttling
+TEMP_WARN      = 70
+
+# displayed values are coarse, the HUD is redrawn (a new pngview) only on a meaningful change
+# (shown step, change needed to update the shown value)
+HUD_LOAD_STEP  = (10, 10)           # percent
+HUD_TEMP_STEP  = (1, 2)             # degrees
+HUD_FREQ_STEP  = (100, 100)         # MHz
+
+# 3x5 glyphs, rows top to bottom
+FONT = {
+    "0" : "111101101101111", "1" : "010110010010111", "2" : "111001111100111",
+    "3" : "111001111001111", "4" : "101101111001001", "5" : "111100111001111",
+    "6" : "111100111101111", "7" : "111001010010010", "8" : "111101111101111",
+    "9" : "111101111001111", "%" : "101001010100101", "C" : "111100100100111",
+    "M" : "101111111101101", "!" : "010010010000010", " " : "000000000000000",
+    "A" : "010101111101101", "I" : "111010010010111", "K" : "101101110101101",
+    "L" : "100100100100111", "S" : "111100111001111", "T" : "111010010010010",
+}
+FONT_SCALE     = 2
+GLYPH_W        = 3 * FONT_SCALE + FONT_SCALE
+GLYPH_H        = 5 * FONT_SCALE
+HUD_PAD        = 2
+COLOR_BG       = (0, 0, 0, 160)
+COLOR_OK       = (96, 255, 96, 255)
+COLOR_WARN     = (255, 224, 64, 255)
+COLOR_THROTTLE = (255, 64, 64, 255)
+
+
+###################################################################################################
+# TEXT RENDERING
+###################################################################################################
+def renderText(text, color):
+    """Render text with the 3x5 font into (width, height, RGBA pixels)"""
+    width  = len(text) * GLYPH_W + HUD_PAD * 2
+    height = GLYPH_H + HUD_PAD * 2
+    pixels = bytearray(COLOR_BG * (width * height))
+    fg     = bytearray(color * FONT_SCALE)
+
+    for (i, ch) in enumerate(text):
+        glyph = FONT.get(ch, FONT[" "])
+        x0    = HUD_PAD + i * GLYPH_W
+        for bit in range(15):
+            if glyph[bit] == "1":
+                x = x0 + (bit % 3) * FONT_SCALE
+                y = HUD_PAD + (bit / 3) * FONT_SCALE
+                for dy in range(FONT_SCALE):
+                    pos = ((y + dy) * width + x) * 4
+                    pixels[pos:pos + len(fg)] = fg
+    return width, height, pixels
+
+
+###################################################################################################
+# PERFORMANCE HUD CLASS
+###################################################################################################
+class PerfHUD(object):
+    def __init__(self):
+        self._fdStat      = self._open(STAT_FILE)
+        self._fdTemp      = self._open(TEMP_FILE)
+        self._fdFreq      = self._open(FREQ_FILE)
+        self._fdThrottled = self._open(THROTTLED_FILE)
+        self._maxFreq     = self._readInt(self._open(FREQ_MAX_FILE, True))
+        self._lastTotal   = None
+        self._lastIdle    = None
+        self._procOSD     = None
+        self._text        = None
+        self._shown       = {}         # load, temp, freq as displayed
+        self._visible     = False
+        self._rate        = RATE_HUD_MS
+        self._lastTS      = 0
+        self._shownTS     = 0
+        self._busy        = 0.0
+
+        self.load         = 0.0
+        self.temp         = None
+        self.freq         = None
+        self.freqDelta    = 0
+        self.throttled    = False
+
+    def _open(self, path, once = False):
+        # files stay open, samples are re-read from offset 0
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        if once:
+            data = self._read(fd)
+            os.close(fd)
+            return data
+        return fd
+
+    def _read(self, fd):
+        if fd == None:
+            return None
+        try:
+            os.lseek(fd, 0, os.SEEK_SET)
+            return os.read(fd, 256)
+        except OSError:
+            return None
+
+    def _readInt(self, data, base = 10):
+        try:
+            return int(data.strip(), base)
+        except (AttributeError, ValueError):
+            return None
+
+    def close(self):
+        self.hide()
+        for fd in (self._fdStat, self._fdTemp, self._fdFreq, self._fdThrottled):
+            if fd != None:
+                os.close(fd)
+        self._fdStat = self._fdTemp = self._fdFreq = self._fdThrottled = None
+
+    def sample(self):
+        # cpu line : user nice system idle iowait irq softirq steal
+        data = self._read(self._fdStat)
+        if data != None:
+            values = [int(v) for v in data.split("\n", 1)[0].split()[1:9]]
+            (total, idle) = (sum(values), values[3] + values[4])
+            if self._lastTotal != None and total > self._lastTotal:
+                self.load = 1.0 - float(idle - self._lastIdle) / (total - self._lastTotal)
+            (self._lastTotal, self._lastIdle) = (total, idle)
+
+        temp = self._readInt(self._read(self._fdTemp))
+        self.temp = temp / 1000 if temp != None else None
+
+        freq = self._readInt(self._read(self._fdFreq))
+        if freq != None:
+            self.freqDelta = freq - self.freq if self.freq != None else 0
+            self.freq = freq
+
+        throttled = self._readInt(self._read(self._fdThrottled), 16)
+        if throttled != None:
+            self.throttled = (throttled & 0xf) != 0         # current under-voltage, capping or throttling
+        else:
+            self.throttled = self.freq != None and self._maxFreq != None and \
+                self.freq < self._maxFreq and self.load > THROTTLE_LOAD
+
+    def _coarse(self, name, value, steps):
+        (step, tolerance) = steps
+        shown = self._shown.get(name)
+        if value == None:
+            shown = None
+        elif shown == None or abs(value - shown) >= tolerance:
+            shown = int(round(float(value) / step)) * step
+        self._shown[name] = shown
+        return shown
+
+    def _getText(self):
+        text = "%d%%" % self._coarse("load", self.load * 100, HUD_LOAD_STEP)
+        temp = self._coarse("temp", self.temp, HUD_TEMP_STEP)
+        if temp != None:
+            text += " %dC" % temp
+        freq = self._coarse("freq", self.freq / 1000 if self.freq != None else None, HUD_FREQ_STEP)
+        if freq != None:
+            text += " %dM" % freq
+        if self.throttled:
+            text += " !"
+
+        if self.throttled:
+            color = COLOR_THROTTLE
+        elif self.temp != None and self.temp >= TEMP_WARN:
+            color = COLOR_WARN
+        else:
+            color = COLOR_OK
+        return text, color
+
+    def _show(self, text, color):
+        (width, height, pixels) = renderText(text, color)
+        self._kill()
+        self._procOSD = AssetPack.showPixels(width, height, pixels, ["-b0x0000", "-l30001", "-n", "-x2", "-y2"])
+
+    def _childCPU(self, pid):
+        # utime + stime of a pngview still running, it is never reaped before it is killed
+        try:
+            with open("/proc/%d/stat" % pid) as f:
+                stat = f.read()
+            fields = stat[stat.rfind(")") + 2:].split()
+            return float(int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (IOError, OSError, ValueError, IndexError):
+            return 0.0
+
+    def _kill(self):
+        if self._procOSD != None:
+            self._busy += self._childCPU(self._procOSD.pid)
+            self._procOSD.terminate()
+            self._procOSD.wait()
+            self._procOSD = None
+
+    def toggle(self):
+        if self._visible:
+            self.hide()
+        else:
+            self._visible = True
+            self._rate    = RATE_HUD_MS
+            self._lastTS  = 0
+            self._shownTS = time.time()
+            self._busy    = 0.0
+
+    def hide(self):
+        if self._visible:
+            self._visible = False
+            self._kill()
+            self._text = None
+            self._shown = {}
+            print("perf hud : %.2f%% cpu, refresh %d ms" % (self.overhead() * 100, self._rate))
+
+    def overhead(self):
+        """Share of wall time spent sampling and drawing since the HUD was shown,
+        cpu time of the pngview processes spawned for each redraw included
+        """
+        elapsed = time.time() - self._shownTS
+        return self._busy / elapsed if elapsed > 0 else 0.0
+
+    def process(self, ts):
+        if not self._visible:
+            return RATE_HUD_MAX_MS
+
+        if ts - self._lastTS < self._rate:
+            return self._rate - (ts - self._lastTS)
+        self._lastTS = ts
+
+        start = time.time()
+        self.sample()
+        (text, color) = self._getText()
+        if (text, color) != self._text:
+            self._text = (text, color)
+            self._show(text, color)
+        self._busy += time.time() - start
+
+        # keep the HUD under its cpu budget by refreshing less often, once a few samples are averaged
+        if time.time() - self._shownTS > RATE_HUD_MAX_MS / 1000.0 and \
+                self.overhead() > HUD_CPU_BUDGET and self._rate < RATE_HUD_MAX_MS:
+            self._rate *= 2
+        return self._rate
+
+
+###################################################################################################
+# MAIN
+###################################################################################################
+_isExit = threading.Event()
+
+def _handleSignal(signum, frame):
+    _isExit.set()
+
+def _main():
+    signal.signal(signal.SIGINT, _handleSignal)
+    signal.signal(signal.SIGTERM, _handleSignal)
+
+    hud = PerfHUD()
+    hud.toggle()
+    while (not _isExit.isSet()):
+        ts   = int(round(time.time() * 1000))
+        left = hud.process(ts)
+        print("load %3d%%  temp %s  freq %s (%+d)  throttled %s" % (hud.load * 100, hud.temp, hud.freq,
+            hud.freqDelta, hud.throttled))
+        if left > 0:
+            time.sleep(left / 1000.0)
+    hud.close()
+
+if __name__ == "__main__":
+    import sys
+
+    try:
+        _main()
+
+    # Catch all other non-exit errors
+    except Exception as e:
+        sys.stderr.write("Unexpected exception: %s" % e)
+        sys.exit(1)
+
+    # Catch the remaining exit errors
+    except:
+        sys.exit(0)
@@ -0,0 +1,158 @@
+import time
+import SoftPowerSwitch
+import BatteryMonitor
+
+###################################################################################################
+# CONSTANTS
+###################################################################################################
+PROFILE_NORMAL   = 0
+PROFILE_SAVER    = 1
+PROFILE_CRITICAL = 2
+
+# name, poll rate scale, device rescan, pulse lcd off
+PROFILES = {
+    PROFILE_NORMAL   : ("normal",   1, True,  False),
+    PROFILE_SAVER    : ("saver",    3, False, False),
+    PROFILE_CRITICAL : ("critical", 6, False, True),
+}
+
+# (enter below, leave above) thresholds, the gap is the hysteresis
+SAVER_PERCENT    = (20, 30)
+SAVER_VOLT       = (3.50 * 2, 3.60 * 2)         # used until a discharge curve is learned
+
+# critical is always judged on voltage : a discharge has to reach VOLT_EMPTY before the shutdown,
+# otherwise BatteryLog.findCycles drops it and the learned curve never follows the aging cells
+CRITICAL_VOLT    = (BatteryMonitor.VOLT_EMPTY, BatteryMonitor.VOLT_EMPTY + 0.2)
+
+# the LCD has a toggle pin only : its state is OSD.lcdOn, tracked from the toggles queued by
+# the joystick and this policy and assumed on at boot. A toggle from the LCD own button is not seen.
+LCD_OFF_CRITICAL = True
+SHUTDOWN_DELAY_S = 120                          # clean shutdown after this long in critical, 0 : never
+RATE_REPORT_MS   = 600000
+
+
+###################################################################################################
+# POWER POLICY CLASS
+###################################################################################################
+class PowerPolicy(object):
+    def __init__(self, msp, joystick, osd):
+        self._msp       = msp
+        self._joystick  = joystick
+        self._osd       = osd
+        self._profile   = PROFILE_NORMAL
+        self._enterTS   = time.time()
+        self._enterPct  = None
+        self._lcdOff    = False                 # the LCD was turned off by this policy
+        self._criticalTS   = None               # entering critical, statistics reports leave it alone
+        self._shuttingDown = False
+        self._lastReportTS = 0
+
+        # per profile : seconds, wakeups, percent drained, seconds measured for drain
+        self._stats     = dict((p, [0.0, 0, 0.0, 0.0]) for p in PROFILES)
+
+    def _nextProfile(self, volt, percent, charging):
+        if charging:
+            return PROFILE_NORMAL
+
+        if percent != None:
+            (level, saver) = (percent, SAVER_PERCENT)
+        else:
+            (level, saver) = (volt, SAVER_VOLT)
+        critical = CRITICAL_VOLT
+
+        profile = self._profile
+        if profile == PROFILE_CRITICAL:
+            if volt > critical[1]:
+                profile = PROFILE_SAVER
+        if profile == PROFILE_SAVER:
+            if level > saver[1]:
+                profile = PROFILE_NORMAL
+            elif volt < critical[0]:
+                profile = PROFILE_CRITICAL
+        if profile == PROFILE_NORMAL:
+            if volt < critical[0]:
+                profile = PROFILE_CRITICAL
+            elif level < saver[0]:
+                profile = PROFILE_SAVER
+        return profile
+
+    def _closeStats(self, now, percent):
+        stat = self._stats[self._profile]
+        stat[0] += now - self._enterTS
+        if self._enterPct != None and percent != None:
+            stat[2] += self._enterPct - percent
+            stat[3] += now - self._enterTS
+
+    def _apply(self, profile, now, percent):
+        self._closeStats(now, percent)
+        self._profile  = profile
+        self._enterTS  = now
+        self._enterPct = percent
+
+        if profile == PROFILE_CRITICAL:
+            self._criticalTS = now
+            self._msp.flushLog()                # the next samples may be the last ones
+        else:
+            self._criticalTS = None
+
+        (name, scale, rescan, lcdOff) = PROFILES[profile]
+        print("power profile : " + name)
+        self._msp.setRateScale(scale)
+        self._joystick.setRateScale(scale, rescan)
+
+        lcdOff = lcdOff and LCD_OFF_CRITICAL
+        if self._osd != None:
+            if lcdOff and self._osd.lcdOn:
+                self._osd.queue('O')
+                self._lcdOff = True
+            elif not lcdOff and self._lcdOff:
+                if not self._osd.lcdOn:
+                    self._osd.queue('O')        # back on, unless it was turned on by hand meanwhile
+                self._lcdOff = False
+
+    def _shutdown(self):
+        self._shuttingDown = True
+        print("battery critical !!")
+        self._msp.stop()                        # joins the MSP thread and flushes the battery log
+        SoftPowerSwitch.shutdown()
+
+    def process(self, ts):
+        """Count a main loop wakeup and switch profile on battery changes"""
+        self._stats[self._profile][1] += 1
+
+        (volt, percent, charging) = self._msp.getBattery()
+        if volt == None:
+            return
+
+        now = ts / 1000.0
+        if charging:
+            percent = None                      # drain is only measured on battery
+        if self._enterPct == None and percent != None:
+            self._enterPct = percent
+
+        profile = self._nextProfile(volt, percent, charging)
+        if profile != self._profile:
+            self._apply(profile, now, percent)
+
+        if self._criticalTS != None and SHUTDOWN_DELAY_S > 0 and not self._shuttingDown and \
+                now - self._criticalTS > SHUTDOWN_DELAY_S:
+            self._shutdown()
+            return
+
+        if ts - self._lastReportTS > RATE_REPORT_MS:
+            self._lastReportTS = ts
+            self.report(now, percent)
+
+    def report(self, now = None, percent = None):
+        if now == None:
+            now = time.time()
+        self._closeStats(now, percent)
+        self._enterTS  = now
+        self._enterPct = percent
+
+        print("power profile statistics")
+        for profile in sorted(PROFILES):
+            (secs, wakeups, drained, measured) = self._stats[profile]
+            rate  = wakeups / secs if secs > 0 else 0.0
+            drain = "%5.1f %%/h" % (drained * 3600.0 / measured) if measured > 0 else "    - %/h"
+            print("  %-8s %8ds %9d wakeups %6.1f /s %s" % (PROFILES[profile][0], secs, wakeups, rate, drain))
@@ -1,24 +1,56 @@
 #!/usr/bin/python
-import serial
 import time
-import array
+_startTS = time.time()
+
 import os
 import signal
-import subprocess
-import math
-import struct
-import RPi.GPIO as GPIO
-import sys, fcntl, termios, signal
-import curses, errno, re
 import threading
-import BatteryMonitor
-import OSD
-import SoftPowerSwitch
+import RPi.GPIO as GPIO
 import VolWiFiMonitor
 
 ###################################################################################################
 # CONSTANTS
 ###################################################################################################
+STARTUP_BUDGET_MS = 2000
+
+
+###################################################################################################
+# STARTUP TIMING
+###################################################################################################
+class StartupTimer(object):
+    def __init__(self, startTS):
+        self._procTS = self._getProcessStart(startTS)
+        self._lastTS = self._procTS
+        self._phases = []
+        self.mark("interpreter", startTS)
+
+    def _getProcessStart(self, default):
+        # process start time from /proc, so that interpreter loading is accounted too
+        try:
+            with open("/proc/self/stat") as f:
+                stat = f.read()
+            with open("/proc/uptime") as f:
+                uptime = float(f.read().split()[0])
+            ticks = float(stat[stat.rfind(")") + 2:].split()[19])
+            return time.time() - uptime + ticks / os.sysconf("SC_CLK_TCK")
+        except (IOError, OSError, ValueError, IndexError):
+            return default
+
+    def mark(self, phase, ts = None):
+        if ts == None:
+            ts = time.time()
+        self._phases.append((phase, int(round((ts - self._lastTS) * 1000))))
+        self._lastTS = ts
+
+    def elapsed(self):
+        return int(round((self._lastTS - self._procTS) * 1000))
+
+    def report(self):
+        print("startup timing report")
+        for (phase, ms) in self._phases:
+            print("  %-16s %6d ms" % (phase, ms))
+        total = self.elapsed()
+        print("  %-16s %6d ms%s" % ("total", total, " (over budget %d ms)" % STARTUP_BUDGET_MS if total > STARTUP_BUDGET_MS else ""))
 
 
 ###################################################################################################
@@ -29,40 +61,135 @@ _isExit = threading.Event()
 def _handleSignal(signum, frame):
     _isExit.set()
 
-def _main(portJoy, portSerial):
+def _importLater(name):
+    """Import a module in background, the returned dict gets "module" (None on ImportError) when done"""
+    result = {}
+    def load():
+        try:
+            result["module"] = __import__(name)
+        except ImportError:
+            result["module"] = None
+    loader = threading.Thread(target = load)
+    loader.setDaemon(True)
+    loader.start()
+    return result
+
+def _createAnalyzer(module, joystick, remapper):
+    analyzer = module.StickAnalyzer()
+    if remapper != None:
+        analyzer.setRawSource(remapper.enableRawEvents())     # js values are calibrated by then
+    else:
+        joystick.addObserver(analyzer)
+    return analyzer
+
+def _main(portJoy, portSerial, portRemap = None, analyze = False, hudButton = None):
+    timer = StartupTimer(_startTS)
+
     signal.signal(signal.SIGINT, _handleSignal)
     signal.signal(signal.SIGTERM, _handleSignal)
     GPIO.setmode(GPIO.BCM)
+    timer.mark("imports")
 
-    msp = BatteryMonitor.SubMSP(portSerial)
-    msp.setDaemon(True)
-    msp.start()
+    # optional host side remapping : grab the evdev pad and publish a calibrated virtual one
+    remapper = None
+    if portRemap != None:
+        import UInputRemapper
+        remapper = UInputRemapper.UInputRemapper(portRemap)
+        try:
+            remapper.open()
+            remapper.setDaemon(True)
+            remapper.start()
+        except (OSError, IOError), e:
+            print "remapper disabled : " + str(e)
+            remapper = None
+        timer.mark("remapper")
+
+    # input first, mixer / wlan states are loaded in background
+    joystick = VolWiFiMonitor.VolWiFiJoystick(portJoy, remapper)
+    if analyze:
+        joystick.enableAnalyzer()
+    joystick.process(int(round(time.time() * 1000)), None)
+    timer.mark("joystick")
 
+    # remaining subsystems are imported after input is live
+    import OSD
     osd = OSD.OSD()
     osd.setDaemon(True)
     osd.start()
+    timer.mark("osd")
+
+    import PerfHUD
+    hud = PerfHUD.PerfHUD()
+    joystick.setHUD(hud, hudButton if hudButton != None else PerfHUD.HUD_BUTTON)
+    timer.mark("perf hud")
 
-    joystick    = VolWiFiMonitor.VolWiFiJoystick(portJoy)
+    import BatteryMonitor
+    msp = BatteryMonitor.SubMSP(portSerial)          # serial port is opened in the MSP thread
+    msp.setDaemon(True)
+    if joystick.analyzer != None:
+        msp.onActivity = joystick.analyzer.markActivity
+    msp.start()
+    timer.mark("msp")
+
+    import SoftPowerSwitch
+    import PowerPolicy
     powerSwitch = SoftPowerSwitch.SoftPowerSwitch()
+    policy      = PowerPolicy.PowerPolicy(msp, joystick, osd)
+    timer.mark("power switch")
+    timer.report()
+
+    # stick health needs numpy, slow to import : loaded while input is already handled, skipped
+    # without numpy. Started last, python 2 holds the import lock until the import is done.
+    analyzer     = None
+    analyzerLoad = _importLater("StickAnalyzer")
 
     while (not _isExit.isSet()):
         ts         = int(round(time.time() * 1000))
         left_msp   = msp.process(ts)
         left_stick = joystick.process(ts, osd)
-        left       = min(left_msp, left_stick)
+        left_hud   = hud.process(ts)
+        left       = min(left_msp, left_stick, left_hud)
+        if analyzerLoad != None and "module" in analyzerLoad:
+            if analyzerLoad["module"] != None:
+                analyzer = _createAnalyzer(analyzerLoad["module"], joystick, remapper)
+            analyzerLoad = None
+        if analyzer != None:
+            left = min(left, analyzer.process(ts))
+        policy.process(ts)
+
+        if timer != None and joystick.firstButtonTS != None:
+            timer.mark("first button", joystick.firstButtonTS)
+            print("first button handled %d ms after process start" % timer.elapsed())
+            timer = None
 
         # sleep
         if left:
             time.sleep(left / 1000.0)
 
+    policy.report()
+    joystick.close()
+    if joystick.analyzer != None:
+        joystick.analyzer.save()
+    hud.close()
+    if analyzer != None:
+        analyzer.close()
     msp.stop()
     osd.stop()
+    if remapper != None:
+        remapper.stop()
 
 if __name__ == "__main__":
     import sys
 
     try:
-        _main(sys.argv[1], sys.argv[2])
+        # options : --analyze, --hud-button=N (js button number toggling the perf HUD)
+        args      = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+        analyze   = "--analyze" in sys.argv[1:]
+        hudButton = None
+        for arg in sys.argv[1:]:
+            if arg.startswith("--hud-button="):
+                hudButton = int(arg.split("=", 1)[1])
+        _main(args[0], args[1], args[2] if len(args) > 2 else None, analyze, hudButton)
 
     # Catch all other non-exit errors
     except Exception as e:
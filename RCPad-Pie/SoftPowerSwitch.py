@@ -9,6 +9,16 @@ PIN_POWER_DOWN    = 4
 TIMEOUT_REBOOT    = 0.5
 TIMEOUT_SHUTDOWN  = 3.0
 
+def shutdown():
+    print("shutdown now !!")
+
+    #workaroud for RPi2
+    GPIO.setup(PIN_POWER_DOWN, GPIO.IN, pull_up_down = GPIO.PUD_DOWN)
+    GPIO.setup(PIN_POWER_DOWN, GPIO.OUT)
+    GPIO.output(PIN_POWER_DOWN, 1)
+    #
+    os.system("sudo shutdown -h now")
+
 class SoftPowerSwitch(object):
     def __init__(self):
         GPIO.setwarnings(False)
@@ -27,14 +37,7 @@ class SoftPowerSwitch(object):
                 return
             time.sleep(0.01)
 
-        print("shutdown now !!")
-
-        #workaroud for RPi2
-        GPIO.setup(PIN_POWER_DOWN, GPIO.IN, pull_up_down = GPIO.PUD_DOWN)
-        GPIO.setup(PIN_POWER_DOWN, GPIO.OUT)
-        GPIO.output(PIN_POWER_DOWN, 1)
-        #
-        os.system("sudo shutdown -h now")
+        shutdown()
 
 
 ###################################################################################################
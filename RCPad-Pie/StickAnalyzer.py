@@ -0,0 +1,182 @@
+import Queue
+import numpy as np
+import AssetPack
+import PerfHUD
+
+###################################################################################################
+# CONSTANTS
+###################################################################################################
+JS_EVENT_AXIS    = 0x02
+RAW_DEV          = -1               # device index of the axes fed by the uinput remapper
+
+RING_SIZE        = 1024             # samples kept per axis
+WINDOW           = 16               # samples per statistics window
+MIN_SAMPLES      = WINDOW * 8
+RATE_ANALYZE_MS  = 5000
+
+# js axis values are -32767..32767
+REST_RANGE       = 4000             # window mean under this may be a stick at rest, a held stick is further out
+REST_STD         = 1500             # and its spread under this
+MOVE_RANGE       = 16000            # beyond this the stick was deliberately moved
+SETTLE_MS        = 500              # rest windows start this long after the stick came back from a move
+REST_HOLD_MS     = 3000             # or a quiet, steady run of windows at least this long without a move
+SPIKE_DELTA      = 4000             # jump out and back in one sample
+DRIFT_THRESHOLD  = 2500             # rest offset asking for recalibration
+NOISE_THRESHOLD  = 600
+PROMPT_MS        = 5000
+RATE_PROMPT_MS   = 600000
+
+
+###################################################################################################
+# AXIS RING BUFFER
+###################################################################################################
+class _AxisRing(object):
+    def __init__(self):
+        self.values  = np.zeros(RING_SIZE, dtype = np.int16)
+        self.times   = np.zeros(RING_SIZE, dtype = np.uint32)
+        self.pos     = 0
+        self.count   = 0
+        self.checked = 0
+
+    def append(self, jsTime, value):
+        self.values[self.pos] = value
+        self.times[self.pos]  = jsTime
+        self.pos   = (self.pos + 1) % RING_SIZE
+        self.count += 1
+
+    def ordered(self):
+        if self.count < RING_SIZE:
+            return self.values[:self.pos], self.times[:self.pos]
+        return np.roll(self.values, -self.pos), np.roll(self.times, -self.pos)
+
+
+###################################################################################################
+# STICK ANALYZER CLASS
+###################################################################################################
+class StickAnalyzer(object):
+    """Stick offset, ADC noise and spikes per axis from the js events seen as an observer.
+    With the uinput remapper active the js values are already calibrated (or the pad is grabbed),
+    setRawSource() must then be given the remapper raw events for the analysis to mean anything.
+    """
+    def __init__(self):
+        self._rings    = {}
+        self._raw      = None
+        self._lastTS   = 0
+        self._promptTS = -RATE_PROMPT_MS
+        self._procOSD  = None
+        self.health    = {}         # (dev, axis) : (rest offset, noise std, spikes per sec, drifting)
+
+    def onEvent(self, dev, ts, jsTime, jsType, jsNumber, jsValue):
+        if jsType != JS_EVENT_AXIS:
+            return
+        key  = (dev, jsNumber)
+        ring = self._rings.get(key)
+        if ring == None:
+            ring = self._rings[key] = _AxisRing()
+        ring.append(jsTime, jsValue)
+
+    def setRawSource(self, events):
+        """Read (pad ms, js axis, value) tuples from a queue, e.g. UInputRemapper.enableRawEvents()"""
+        self._raw = events
+
+    def _drainRaw(self):
+        while True:
+            try:
+                (jsTime, number, value) = self._raw.get_nowait()
+            except Queue.Empty:
+                return
+            self.onEvent(RAW_DEV, None, jsTime, JS_EVENT_AXIS, number, value)
+
+    def _settled(self, values, times):
+        # samples after the stick came back from a large move and stayed for SETTLE_MS
+        index = np.arange(len(values))
+        moved = np.abs(values.astype(np.int32)) > MOVE_RANGE
+        last  = np.maximum.accumulate(np.where(moved, index, -1))
+        since = (times.astype(np.int64) - times[np.maximum(last, 0)].astype(np.int64)) & 0xffffffff
+        return (last >= 0) & ~moved & (since >= SETTLE_MS)
+
+    def _held(self, means, quiet, times):
+        # runs of quiet windows whose means stay within REST_STD for REST_HOLD_MS, an untouched
+        # noisy stick keeps sending events without ever being moved
+        held  = np.zeros(len(means), dtype = bool)
+        start = 0
+        for i in range(len(means)):
+            if not quiet[i] or abs(means[i] - means[start]) > REST_STD:
+                start = i if quiet[i] else i + 1
+            if start <= i and ((int(times[i, -1]) - int(times[start, 0])) & 0xffffffff) >= REST_HOLD_MS:
+                held[start:i + 1] = True
+        return held
+
+    def _analyze(self, ring):
+        (values, times) = ring.ordered()
+        n = len(values) / WINDOW * WINDOW
+        if n < MIN_SAMPLES:
+            return None
+
+        # windowed statistics, the settled rest windows give offset and ADC noise
+        win     = values[-n:].astype(np.float32).reshape(-1, WINDOW)
+        means   = win.mean(axis = 1)
+        var     = win.var(axis = 1)
+        quiet   = (var < REST_STD * REST_STD) & (np.abs(win).max(axis = 1) <= MOVE_RANGE)
+        settled = self._settled(values, times)[-n:].reshape(-1, WINDOW).all(axis = 1)
+        held    = self._held(means, quiet, times[-n:].reshape(-1, WINDOW))
+        rest    = (settled | held) & quiet & (np.abs(means) < REST_RANGE)
+        if not rest.any():
+            return None
+        offset = float(np.median(means[rest]))
+        noise  = float(np.sqrt(np.median(var[rest])))
+
+        # spikes : a large jump immediately reverted
+        diff   = np.diff(values.astype(np.int32))
+        spikes = (np.abs(diff[:-1]) > SPIKE_DELTA) & (np.abs(diff[1:]) > SPIKE_DELTA) & \
+                 (np.sign(diff[:-1]) != np.sign(diff[1:]))
+        span   = (int(times[-1]) - int(times[0])) & 0xffffffff
+        rate   = float(spikes.sum()) * 1000.0 / span if span > 0 else 0.0
+
+        drifting = abs(offset) > DRIFT_THRESHOLD or noise > NOISE_THRESHOLD
+        return offset, noise, rate, drifting
+
+    def _prompt(self, ts, keys):
+        if ts - self._promptTS < RATE_PROMPT_MS:
+            return
+        self._promptTS = ts
+        for key in keys:
+            (offset, noise, rate, drifting) = self.health[key]
+            print("stick %d axis %d needs calibration : offset %d, noise %d, spikes %.1f/s" %
+                (key[0], key[1], offset, noise, rate))
+
+        if self._procOSD != None:
+            self._procOSD.terminate()
+            self._procOSD.wait()
+        (width, height, pixels) = PerfHUD.renderText("STICK CAL !", PerfHUD.COLOR_WARN)
+        self._procOSD = AssetPack.showPixels(width, height, pixels,
+            ["-b0x0000", "-l30001", "-n", "-t" + str(PROMPT_MS)])
+
+    def close(self):
+        if self._procOSD != None:
+            self._procOSD.terminate()
+            self._procOSD.wait()
+            self._procOSD = None
+
+    def process(self, ts):
+        if self._raw != None:
+            self._drainRaw()
+
+        if ts - self._lastTS < RATE_ANALYZE_MS:
+            return RATE_ANALYZE_MS - (ts - self._lastTS)
+        self._lastTS = ts
+
+        drifting = []
+        for (key, ring) in self._rings.items():
+            if ring.count == ring.checked:
+                continue
+            ring.checked = ring.count
+            result = self._analyze(ring)
+            if result != None:
+                self.health[key] = result
+                if result[3]:
+                    drifting.append(key)
+
+        if drifting:
+            self._prompt(ts, drifting)
+        return RATE_ANALYZE_MS
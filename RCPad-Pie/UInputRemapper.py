@@ -0,0 +1,466 @@
+import os
+import time
+import array
+import struct
+import fcntl
+import select
+import signal
+import errno
+import threading
+import Queue
+
+###################################################################################################
+# CONSTANTS
+###################################################################################################
+APP_PATH        = os.path.dirname(os.path.abspath(__file__))
+CAL_FILE        = APP_PATH + "/axis_calibration.conf"
+UINPUT_DEV      = "/dev/uinput"
+REMAP_NAME      = "RCPad Virtual Gamepad"
+RATE_REOPEN_MS  = 1000
+
+# js button numbers handled by the daemon (volume, wifi, OSD keys), never sent to emulators
+FILTER_BUTTONS  = range(16, 25)
+
+# default response shaping, overridable per axis in CAL_FILE
+AXIS_DEADZONE   = 0.06              # ratio of half travel
+AXIS_CURVE      = 0.3               # 0 : linear, 1 : cubic
+AXIS_OUT_MAX    = 32767
+AXIS_LUT_MAX    = 65536             # largest raw range a LUT is built for
+RAW_QUEUE_MAX   = 4096              # raw events / reads kept for a slow consumer
+
+# linux input
+EV_SYN          = 0x00
+EV_KEY          = 0x01
+EV_ABS          = 0x03
+SYN_REPORT      = 0
+BTN_MISC        = 0x100
+BTN_JOYSTICK    = 0x120
+KEY_MAX         = 0x2ff
+ABS_HAT0X       = 0x10
+ABS_HAT3Y       = 0x17
+ABS_MAX         = 0x3f
+ABS_CNT         = ABS_MAX + 1
+
+EVENT_FORMAT    = "llHHi"
+EVENT_SIZE      = struct.calcsize(EVENT_FORMAT)
+ABSINFO_FORMAT  = "iiiiii"          # value, min, max, fuzz, flat, resolution
+USERDEV_FORMAT  = "80sHHHHI" + "%di" % (ABS_CNT * 4)
+
+def _IOC(dir, type, nr, size):
+    return (dir << 30) | (size << 16) | (ord(type) << 8) | nr
+
+UI_DEV_CREATE   = _IOC(0, 'U', 1, 0)
+UI_DEV_DESTROY  = _IOC(0, 'U', 2, 0)
+UI_SET_EVBIT    = _IOC(1, 'U', 100, 4)
+UI_SET_KEYBIT   = _IOC(1, 'U', 101, 4)
+UI_SET_ABSBIT   = _IOC(1, 'U', 103, 4)
+EVIOCGRAB       = _IOC(1, 'E', 0x90, 4)
+
+def EVIOCGBIT(ev, size):
+    return _IOC(2, 'E', 0x20 + ev, size)
+
+def EVIOCGABS(abs):
+    return _IOC(2, 'E', 0x40 + abs, struct.calcsize(ABSINFO_FORMAT))
+
+
+###################################################################################################
+# AXIS LOOKUP TABLES
+###################################################################################################
+def buildAxisLUT(rawMin, rawMax, calMin, calCenter, calMax, deadzone = AXIS_DEADZONE, curve = AXIS_CURVE,
+                 outMax = AXIS_OUT_MAX):
+    """Precompute output values for every raw value in [rawMin, rawMax].
+    Raw values are centered and scaled by the calibration, then deadzone and
+    expo curve are applied. Index the table with (raw - rawMin).
+    """
+    lut = array.array('i', [0] * (rawMax - rawMin + 1))
+    for raw in range(rawMin, rawMax + 1):
+        if raw >= calCenter:
+            span = calMax - calCenter
+            x    = float(raw - calCenter) / span if span > 0 else 0.0
+        else:
+            span = calCenter - calMin
+            x    = float(raw - calCenter) / span if span > 0 else 0.0
+        mag  = min(abs(x), 1.0)
+
+        if mag <= deadzone:
+            mag = 0.0
+        else:
+            mag = (mag - deadzone) / (1.0 - deadzone)
+            mag = (1.0 - curve) * mag + curve * mag * mag * mag
+
+        lut[raw - rawMin] = int(round(mag * outMax)) * (1 if x >= 0 else -1)
+    return lut
+
+def loadCalibration(path = CAL_FILE):
+    """Read per axis calibration lines : <abs code> <min> <center> <max> [deadzone] [curve]"""
+    cal = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                items = line.split("#")[0].split()
+                if len(items) < 4:
+                    continue
+                code  = int(items[0], 0)
+                entry = [int(items[1]), int(items[2]), int(items[3]), AXIS_DEADZONE, AXIS_CURVE]
+                if len(items) > 4:
+                    entry[3] = float(items[4])
+                if len(items) > 5:
+                    entry[4] = float(items[5])
+                cal[code] = entry
+    except (IOError, ValueError):
+        pass
+    return cal
+
+
+###################################################################################################
+# UINPUT REMAPPER CLASS
+###################################################################################################
+class UInputRemapper(threading.Thread):
+    def __init__(self, dev, name = REMAP_NAME, calibration = None):
+        threading.Thread.__init__(self)
+        self._dev       = dev
+        self._name      = name
+        self._cal       = calibration if calibration != None else loadCalibration()
+        self._exitNow   = threading.Event()
+        self._fdIn      = None
+        self._fdOut     = None
+        self._created   = False
+        self._luts      = {}
+        self._jsNumbers = {}
+        self._jsAxes    = {}
+        self._frame     = 0                           # events forwarded since the last SYN_REPORT
+        self.specialEvents = Queue.Queue()           # (js number, value) of filtered buttons
+        self.rawEvents     = None                    # (pad ms, js axis, value) before calibration
+        self.rawReads      = None                    # (host us, evdev events) as read from the pad
+
+    def _getBits(self, fd, ev, count):
+        bits = array.array('B', [0] * ((count + 7) / 8))
+        fcntl.ioctl(fd, EVIOCGBIT(ev, len(bits)), bits, True)
+        return [i for i in range(count) if bits[i / 8] & (1 << (i % 8))]
+
+    def _mapJsNumbers(self, keys):
+        # same ordering as the joydev driver which gives the js button numbers
+        order = [k for k in keys if k >= BTN_JOYSTICK] + [k for k in keys if BTN_MISC <= k < BTN_JOYSTICK]
+        return dict((k, i) for (i, k) in enumerate(order))
+
+    def _openInput(self):
+        # the evdev path should be stable across replugs, e.g. a /dev/input/by-id link
+        self._fdIn = os.open(self._dev, os.O_RDONLY | os.O_NONBLOCK)
+        keys = self._getBits(self._fdIn, EV_KEY, KEY_MAX + 1)
+        axes = self._getBits(self._fdIn, EV_ABS, ABS_CNT)
+        self._jsNumbers = self._mapJsNumbers(keys)
+        self._jsAxes    = dict((code, i) for (i, code) in enumerate(axes))
+
+        ranges = {}
+        luts   = {}
+        for code in axes:
+            info = array.array('i', [0] * 6)
+            fcntl.ioctl(self._fdIn, EVIOCGABS(code), info, True)
+            (rawMin, rawMax) = (info[1], info[2])
+            # only analog sticks are shaped, hats (-1..1) keep their own range
+            if not ABS_HAT0X <= code <= ABS_HAT3Y and rawMax - rawMin < AXIS_LUT_MAX:
+                (calMin, calCenter, calMax, deadzone, curve) = self._cal.get(code,
+                    [rawMin, (rawMin + rawMax) / 2, rawMax, AXIS_DEADZONE, AXIS_CURVE])
+                luts[code]   = (rawMin, rawMax, buildAxisLUT(rawMin, rawMax, calMin, calCenter, calMax, deadzone, curve))
+                ranges[code] = (-AXIS_OUT_MAX, AXIS_OUT_MAX)
+            else:
+                ranges[code] = (rawMin, rawMax)
+        self._luts = luts
+
+        # take the pad away from other readers, the virtual device replaces it
+        fcntl.ioctl(self._fdIn, EVIOCGRAB, 1)
+        return keys, ranges
+
+    def _createOutput(self, keys, ranges):
+        absMin = [0] * ABS_CNT
+        absMax = [0] * ABS_CNT
+        self._fdOut = os.open(UINPUT_DEV, os.O_WRONLY | os.O_NONBLOCK)
+        fcntl.ioctl(self._fdOut, UI_SET_EVBIT, EV_KEY)
+        fcntl.ioctl(self._fdOut, UI_SET_EVBIT, EV_ABS)
+
+        # filtered buttons stay registered (never emitted) to keep the js numbering of the pad
+        for code in keys:
+            fcntl.ioctl(self._fdOut, UI_SET_KEYBIT, code)
+        for (code, (low, high)) in ranges.items():
+            fcntl.ioctl(self._fdOut, UI_SET_ABSBIT, code)
+            (absMin[code], absMax[code]) = (low, high)
+
+        userDev = struct.pack(USERDEV_FORMAT, self._name, 0x06, 0x1209, 0x0001, 1, 0,
+            *(absMax + absMin + [0] * ABS_CNT + [0] * ABS_CNT))
+        os.write(self._fdOut, userDev)
+        fcntl.ioctl(self._fdOut, UI_DEV_CREATE)
+        self._created = True
+
+    def open(self):
+        """Grab the pad and create the virtual device, raise OSError / IOError with nothing left open"""
+        try:
+            (keys, ranges) = self._openInput()
+            self._createOutput(keys, ranges)
+        except (OSError, IOError):
+            self.close()
+            raise
+
+    def _closeInput(self):
+        if self._fdIn != None:
+            try:
+                fcntl.ioctl(self._fdIn, EVIOCGRAB, 0)
+            except IOError:
+                pass
+            os.close(self._fdIn)
+            self._fdIn = None
+        self._frame = 0
+
+    def close(self):
+        self._closeInput()
+        if self._fdOut != None:
+            if self._created:
+                try:
+                    fcntl.ioctl(self._fdOut, UI_DEV_DESTROY)
+                except IOError:
+                    pass
+                self._created = False
+            os.close(self._fdOut)
+            self._fdOut = None
+
+    def enableRawEvents(self):
+        """Publish the axis values read from the pad before calibration, dead zone and curve.
+        Values are scaled linearly to the js range with the middle of the raw range as 0.
+        """
+        if self.rawEvents == None:
+            self.rawEvents = Queue.Queue(RAW_QUEUE_MAX)
+        return self.rawEvents
+
+    def enableRawReads(self):
+        """Publish every chunk read from the pad with the host time (us) the read returned at"""
+        if self.rawReads == None:
+            self.rawReads = Queue.Queue(RAW_QUEUE_MAX)
+        return self.rawReads
+
+    def _putRaw(self, sec, usec, code, value, rawMin, rawMax):
+        number = self._jsAxes.get(code)
+        if number == None or rawMax <= rawMin:
+            return
+        scaled = (2 * value - rawMin - rawMax) * AXIS_OUT_MAX / (rawMax - rawMin)
+        try:
+            self.rawEvents.put_nowait(((sec * 1000 + usec / 1000) & 0xffffffff, number, scaled))
+        except Queue.Full:
+            pass
+
+    def _translate(self, data):
+        """Translate a chunk of input events, return the events to forward"""
+        out   = []
+        for pos in range(0, len(data) - EVENT_SIZE + 1, EVENT_SIZE):
+            (sec, usec, type, code, value) = struct.unpack_from(EVENT_FORMAT, data, pos)
+            if type == EV_ABS:
+                lut = self._luts.get(code)
+                if lut != None:
+                    (rawMin, rawMax, table) = lut
+                    if self.rawEvents != None:
+                        self._putRaw(sec, usec, code, value, rawMin, rawMax)
+                    value = table[min(max(value, rawMin), rawMax) - rawMin]
+            elif type == EV_KEY:
+                number = self._jsNumbers.get(code)
+                if number in FILTER_BUTTONS:
+                    self.specialEvents.put((number, value))
+                    continue
+            elif type == EV_SYN and code == SYN_REPORT:
+                # skip reports left empty by filtered buttons
+                if self._frame == 0:
+                    continue
+                self._frame = 0
+                out.append(struct.pack(EVENT_FORMAT, 0, 0, type, code, value))
+                continue
+            out.append(struct.pack(EVENT_FORMAT, 0, 0, type, code, value))
+            self._frame += 1
+        return "".join(out)
+
+    def pump(self):
+        """Forward all pending input events, return False if the pad is gone"""
+        while True:
+            try:
+                data = os.read(self._fdIn, EVENT_SIZE * 64)
+            except OSError, e:
+                if e.errno == errno.EWOULDBLOCK:
+                    return True
+                return False
+            if not data:
+                return False
+            if self.rawReads != None:
+                try:
+                    self.rawReads.put_nowait((int(time.time() * 1000000), data))
+                except Queue.Full:
+                    pass
+            out = self._translate(data)
+            if out:
+                try:
+                    os.write(self._fdOut, out)
+                except OSError, e:
+                    print "remapper write error: " + str(e)
+
+    def _reopenInput(self):
+        # the virtual device stays, emulators keep their handle while the pad is away
+        try:
+            self._openInput()
+            print("remapper : pad grabbed again")
+        except (OSError, IOError):
+            self._closeInput()
+
+    def run(self):
+        while (not self._exitNow.isSet()):
+            if self._fdIn == None:
+                self._exitNow.wait(RATE_REOPEN_MS / 1000.0)
+                self._reopenInput()
+                continue
+            try:
+                ready = select.select([self._fdIn], [], [], 0.5)[0]
+            except select.error:
+                continue
+            if ready and not self.pump():
+                print("remapper : pad unplugged")
+                self._closeInput()
+        self.close()
+        print("Remapper thread finished")
+
+    def stop(self):
+        self._exitNow.set()
+        self.join()
+
+
+###################################################################################################
+# LOOPBACK BENCHMARK
+###################################################################################################
+def _findEventNode(name):
+    with open("/proc/bus/input/devices") as f:
+        blocks = f.read().split("\n\n")
+    for block in blocks:
+        if ('Name="%s"' % name) in block:
+            for handler in block.split("Handlers=")[1].split("\n")[0].split():
+                if handler.startswith("event"):
+                    return "/dev/input/" + handler
+    return None
+
+def _measure(src, sink, count):
+    # time from writing a report into the source to reading it back from the sink
+    lat = []
+    for i in range(count):
+        value = (i * 37) % 1024
+        ts = time.time()
+        os.write(src, struct.pack(EVENT_FORMAT, 0, 0, EV_ABS, 0, value) + struct.pack(EVENT_FORMAT, 0, 0, EV_SYN, SYN_REPORT, 0))
+        while True:
+            (sec, usec, type, code, v) = struct.unpack(EVENT_FORMAT, os.read(sink, EVENT_SIZE))
+            if type == EV_SYN:
+                break
+        lat.append((time.time() - ts) * 1000000.0)
+        time.sleep(0.002)
+    return lat
+
+def _benchmarkUInput(count, cal):
+    # loopback source : a uinput pad with 2 axes and 32 buttons
+    src = os.open(UINPUT_DEV, os.O_WRONLY)
+    fcntl.ioctl(src, UI_SET_EVBIT, EV_KEY)
+    fcntl.ioctl(src, UI_SET_EVBIT, EV_ABS)
+    for i in range(32):
+        fcntl.ioctl(src, UI_SET_KEYBIT, BTN_JOYSTICK + i if i < 16 else 0x2c0 + i - 16)
+    absMin = [0] * ABS_CNT
+    absMax = [0] * ABS_CNT
+    for code in (0, 1):
+        fcntl.ioctl(src, UI_SET_ABSBIT, code)
+        absMax[code] = 1023
+    os.write(src, struct.pack(USERDEV_FORMAT, "RCPad loopback", 0x06, 0x1209, 0x0002, 1, 0,
+        *(absMax + absMin + [0] * ABS_CNT + [0] * ABS_CNT)))
+    fcntl.ioctl(src, UI_DEV_CREATE)
+    time.sleep(0.5)
+
+    remapper = UInputRemapper(_findEventNode("RCPad loopback"), "RCPad loopback remap", cal)
+    remapper.open()
+    remapper.setDaemon(True)
+    remapper.start()
+    time.sleep(0.5)
+    sink = os.open(_findEventNode("RCPad loopback remap"), os.O_RDONLY)
+
+    lat = _measure(src, sink, count)
+
+    remapper.stop()
+    os.close(sink)
+    fcntl.ioctl(src, UI_DEV_DESTROY)
+    os.close(src)
+    return lat
+
+def _benchmarkPipe(count, cal):
+    # without uinput : pipes stand in for the evdev and uinput nodes, this measures the remapper
+    # thread alone (wakeup, translation, write) but not the kernel input layer
+    (inR, src)  = os.pipe()
+    (sink, outW) = os.pipe()
+    fcntl.fcntl(inR, fcntl.F_SETFL, fcntl.fcntl(inR, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    remapper = UInputRemapper("pipe", "pipe", cal)
+    (remapper._fdIn, remapper._fdOut) = (inR, outW)
+    remapper._luts = {0 : (0, 1023, buildAxisLUT(0, 1023, *cal[0]))}
+    remapper.setDaemon(True)
+    remapper.start()
+
+    lat = _measure(src, sink, count)
+
+    remapper.stop()
+    os.close(src)
+    os.close(sink)
+    return lat
+
+def _benchmark(count):
+    # linear, no deadzone : every source value gives a distinct output event
+    cal = {0 : [0, 511, 1023, 0.0, 0.0]}
+    if os.path.exists(UINPUT_DEV):
+        (label, lat) = ("uinput loopback", _benchmarkUInput(count, cal))
+    else:
+        (label, lat) = ("pipe loopback, no " + UINPUT_DEV, _benchmarkPipe(count, cal))
+
+    lat.sort()
+    p99 = lat[int(len(lat) * 0.99) - 1]
+    print("remap latency (%s) : avg %.0f us, p50 %.0f us, p99 %.0f us, max %.0f us" %
+        (label, sum(lat) / len(lat), lat[len(lat) / 2], p99, lat[-1]))
+    print("PASS" if p99 < 1000 else "FAIL : p99 over 1 ms")
+    return p99 < 1000
+
+
+###################################################################################################
+# MAIN
+###################################################################################################
+_isExit = threading.Event()
+
+def _handleSignal(signum, frame):
+    _isExit.set()
+
+def _main(dev):
+    signal.signal(signal.SIGINT, _handleSignal)
+    signal.signal(signal.SIGTERM, _handleSignal)
+
+    remapper = UInputRemapper(dev)
+    remapper.open()
+    remapper.setDaemon(True)
+    remapper.start()
+
+    while (not _isExit.isSet()):
+        time.sleep(0.5)
+
+    remapper.stop()
+
+if __name__ == "__main__":
+    import sys
+
+    result = True
+    try:
+        if sys.argv[1] == "--bench":
+            result = _benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
+        else:
+            _main(sys.argv[1])
+
+    # Catch all other non-exit errors
+    except Exception as e:
+        sys.stderr.write("Unexpected exception: %s" % e)
+        sys.exit(1)
+
+    # Catch the remaining exit errors
+    except:
+        sys.exit(0)
+
+    sys.exit(0 if result else 1)
@@ -1,12 +1,13 @@
 import time
-import array
 import os
 import subprocess
-import math
 import struct
-import sys, fcntl, termios, signal
-import curses, errno, re
+import signal
+import errno
+import select
 import threading
+import collections
+import AssetPack
 
 ###################################################################################################
 # CONSTANTS
@@ -15,16 +16,49 @@ APP_PATH      = os.path.dirname(os.path.abspath(__file__))
 RATE_RESCAN_MS= 2000
 RATE_EVENT_MS = 50
 
+# report rate analyzer
+SUMMARY_FILE  = APP_PATH + "/report_rate.summary"
+HIST_BINS     = 50                  # 1 ms bins, the last one collects longer intervals
+EVENT_FORMAT  = "llHHi"             # evdev input_event : timeval, type, code, value
+EVENT_SIZE    = struct.calcsize(EVENT_FORMAT)
+EV_SYN        = 0x00
+SYN_REPORT    = 0
+SYN_DROPPED   = 3
+GAP_MIN_MS    = 20                  # firmware reports sticks every 5 ms while they move
+IDLE_MS       = 250                 # longer silences are a stick at rest, not a gap
+ACTIVITY_SLACK= 5
+RATE_READER_MS= 500                 # evdev reader : device list check while idle
+
 ###################################################################################################
 # VOLUME WIFI MANAGER CLASS
 ###################################################################################################
 class VolWiFiManager(object):
     def __init__(self):
         self._procOSD  = None
-        self._curVol   = int(self._getCmdResult("amixer get PCM|grep -o [0-9]*%|sed 's/%//'"))
-        self._curWiFi  = self._getCmdResult("cat /sys/class/net/wlan0/operstate")       # up or down
-        self._curWiFi  = self._curWiFi.strip().lower()
-        #print self._curWiFi
+        self._curVol   = 0
+        self._curWiFi  = "down"
+
+        # query mixer and wlan state in background not to delay opening the joystick
+        self._loaded   = threading.Event()
+        loader = threading.Thread(target = self._loadState)
+        loader.setDaemon(True)
+        loader.start()
+
+    def _loadState(self):
+        # each query on its own, the main loop waits on _loaded whatever happens here
+        try:
+            try:
+                self._curVol  = int(self._getCmdResult("amixer get PCM|grep -o [0-9]*%|sed 's/%//'"))
+            except (ValueError, OSError), e:
+                print "mixer state error: " + str(e)
+            try:
+                self._curWiFi = self._getCmdResult("cat /sys/class/net/wlan0/operstate")       # up or down
+                self._curWiFi = self._curWiFi.strip().lower()
+                #print self._curWiFi
+            except OSError, e:
+                print "wlan state error: " + str(e)
+        finally:
+            self._loaded.set()
 
     def _getCmdResult(self, cmd):
         p = subprocess.Popen(cmd, shell = True, stdout = subprocess.PIPE)
@@ -36,30 +70,32 @@ class VolWiFiManager(object):
             self._procOSD.terminate()
             self._procOSD.wait()
 
-        self._procOSD = subprocess.Popen([APP_PATH + "/pngview", "-b0x0000", "-l30000", "-n", "-t1000",
-            APP_PATH + "/volume" + str(vol / 6) + ".png"])
+        self._procOSD = AssetPack.showImage("volume" + str(vol / 6), ["-b0x0000", "-l30000", "-n", "-t1000"])
 
     def _dispWiFi(self, state):
         if self._procOSD != None:
             self._procOSD.terminate()
             self._procOSD.wait()
 
-        self._procOSD = subprocess.Popen([APP_PATH + "/pngview", "-b0x0000", "-l30000", "-n", "-t1000",
-            APP_PATH + "/wifi-" + ("on" if state == "up" else "off") + ".png"])
+        self._procOSD = AssetPack.showImage("wifi-" + ("on" if state == "up" else "off"),
+            ["-b0x0000", "-l30000", "-n", "-t1000"])
 
     def incVolume(self):
+        self._loaded.wait()
         if self._curVol < 95:
             self._curVol += 6
             self._getCmdResult("amixer set PCM -- " + str(self._curVol) + "%")
         self._dispVolume(self._curVol)
 
     def decVolume(self):
+        self._loaded.wait()
         if self._curVol > 5:
             self._curVol -= 6
             self._getCmdResult("amixer set PCM -- " + str(self._curVol) + "%")
         self._dispVolume(self._curVol)
 
     def toggleWiFi(self):
+        self._loaded.wait()
         if self._curWiFi == "up":
             self._getCmdResult("sudo ifconfig wlan0 down")
             self._curWiFi = "down"
@@ -69,16 +105,220 @@ class VolWiFiManager(object):
         self._dispWiFi(self._curWiFi)
 
 
+###################################################################################################
+# REPORT RATE ANALYZER
+###################################################################################################
+class ReportRateAnalyzer(object):
+    """Histograms of report inter-arrival (evdev timestamps) and read delay (host side) per device.
+    Reports are split on SYN_REPORT, gaps in the reports are matched against MSP traffic and hotplug rescans.
+    """
+    def __init__(self):
+        self._devs     = {}
+        self._activity = collections.deque(maxlen = 256)    # (host ms, kind)
+
+    def _newDev(self):
+        return {
+            "reports"  : 0,
+            "events"   : 0,             # events in the report being read
+            "lastUS"   : None,
+            "interval" : [0] * HIST_BINS,
+            "delay"    : [0] * HIST_BINS,
+            "moving"   : [0, 0, 0],     # count, sum and sum of squares of intervals under GAP_MIN_MS in us
+            "gaps"     : {"total" : 0, "msp" : 0, "rescan" : 0, "unexplained" : 0},
+            "maxGap"   : 0,
+            "dropped"  : 0,
+        }
+
+    def markActivity(self, kind, ts):
+        """Record host side activity (ms) that may delay reports : msp-tx, msp-rx, rescan"""
+        self._activity.append((ts, kind))
+
+    def _matchGap(self, start, end):
+        kinds = set()
+        for (ts, kind) in list(self._activity):
+            if start - ACTIVITY_SLACK <= ts <= end + ACTIVITY_SLACK:
+                kinds.add(kind.split("-")[0])
+        return kinds
+
+    def feed(self, dev, readUS, data):
+        """Account a chunk of evdev events, readUS is the host time (us) the chunk was read at"""
+        stat = self._devs.get(dev)
+        if stat == None:
+            stat = self._devs[dev] = self._newDev()
+
+        for pos in range(0, len(data) - EVENT_SIZE + 1, EVENT_SIZE):
+            (sec, usec, type, code, value) = struct.unpack_from(EVENT_FORMAT, data, pos)
+            if type != EV_SYN:
+                stat["events"] += 1
+            elif code == SYN_DROPPED:
+                # the kernel buffer overflowed, the interval to the next report is not measured
+                stat["dropped"] += 1
+                stat["events"]   = 0
+                stat["lastUS"]   = None
+            elif code == SYN_REPORT and stat["events"] > 0:
+                stat["events"] = 0
+                self._report(stat, sec * 1000000 + usec, readUS)
+
+    def _report(self, stat, reportUS, readUS):
+        # evdev timestamps and time.time() are both CLOCK_REALTIME
+        stat["reports"] += 1
+        stat["delay"][min(max(readUS - reportUS, 0) / 1000, HIST_BINS - 1)] += 1
+
+        last = stat["lastUS"]
+        stat["lastUS"] = reportUS
+        if last == None or reportUS < last:
+            return
+
+        interval = reportUS - last
+        ms       = interval / 1000
+        stat["interval"][min(ms, HIST_BINS - 1)] += 1
+        if ms < GAP_MIN_MS:
+            moving = stat["moving"]
+            moving[0] += 1
+            moving[1] += interval
+            moving[2] += interval * interval
+        elif ms < IDLE_MS:
+            stat["gaps"]["total"] += 1
+            stat["maxGap"] = max(stat["maxGap"], ms)
+            kinds = self._matchGap(last / 1000, reportUS / 1000)
+            for kind in ("msp", "rescan"):
+                if kind in kinds:
+                    stat["gaps"][kind] += 1
+            if not kinds:
+                stat["gaps"]["unexplained"] += 1
+
+    def _percentile(self, hist, ratio):
+        total = sum(hist)
+        count = 0
+        for (i, n) in enumerate(hist):
+            count += n
+            if count >= total * ratio:
+                return i
+        return HIST_BINS - 1
+
+    def summary(self):
+        lines = []
+        for dev in sorted(self._devs):
+            stat = self._devs[dev]
+            hist = stat["interval"][:GAP_MIN_MS]     # intervals while the sticks are moving
+            (n, total, squares) = stat["moving"]
+            mean = float(total) / n if n else 0.0
+            var  = max(float(squares) / n - mean * mean, 0.0) if n else 0.0
+            gaps = stat["gaps"]
+            lines.append("dev%d.reports=%d" % (dev, stat["reports"]))
+            lines.append("dev%d.interval_mean_ms=%.3f" % (dev, mean / 1000))
+            lines.append("dev%d.interval_jitter_ms=%.3f" % (dev, var ** 0.5 / 1000))
+            lines.append("dev%d.interval_p50_ms=%d" % (dev, self._percentile(hist, 0.5)))
+            lines.append("dev%d.interval_p99_ms=%d" % (dev, self._percentile(hist, 0.99)))
+            lines.append("dev%d.host_delay_p50_ms=%d" % (dev, self._percentile(stat["delay"], 0.5)))
+            lines.append("dev%d.host_delay_p99_ms=%d" % (dev, self._percentile(stat["delay"], 0.99)))
+            lines.append("dev%d.gaps=%d" % (dev, gaps["total"]))
+            lines.append("dev%d.gaps_msp=%d" % (dev, gaps["msp"]))
+            lines.append("dev%d.gaps_rescan=%d" % (dev, gaps["rescan"]))
+            lines.append("dev%d.gaps_unexplained=%d" % (dev, gaps["unexplained"]))
+            lines.append("dev%d.gap_max_ms=%d" % (dev, stat["maxGap"]))
+            lines.append("dev%d.dropped=%d" % (dev, stat["dropped"]))
+            lines.append("dev%d.interval_hist=%s" % (dev, ",".join(str(c) for c in stat["interval"])))
+        return "\n".join(lines)
+
+    def save(self, path = SUMMARY_FILE):
+        summary = self.summary()
+        print(summary)
+        try:
+            with open(path, "w") as f:
+                f.write(summary + "\n")
+        except IOError, e:
+            print "report rate summary write error: " + str(e)
+
+
+class EvdevReader(threading.Thread):
+    """Read the evdev nodes next to the js nodes for the report rate analyzer, from select() so that
+    the read delay is the host latency seen by any reader, not the main loop sleep.
+    """
+    def __init__(self, analyzer):
+        threading.Thread.__init__(self)
+        self._analyzer = analyzer
+        self._exitNow  = threading.Event()
+        self._devs     = []             # js devices wanted, set by the main loop
+        self._opened   = []             # js devices the fds belong to
+        self._fds      = []
+
+    def setDevices(self, devs):
+        self._devs = list(devs)
+
+    def _open(self, dev):
+        # evdev node of the same input device, not grabbed, its events carry us timestamps and SYN_REPORT
+        try:
+            name = os.path.basename(os.path.realpath(dev))
+            for node in os.listdir("/sys/class/input/%s/device" % name):
+                if node.startswith("event"):
+                    return os.open("/dev/input/" + node, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            pass
+        return None
+
+    def _close(self):
+        for fd in self._fds:
+            if fd != None:
+                os.close(fd)
+        self._fds = []
+
+    def _reopen(self):
+        self._close()
+        self._opened = self._devs
+        self._fds    = [self._open(dev) for dev in self._opened]
+
+    def run(self):
+        while (not self._exitNow.isSet()):
+            if self._devs != self._opened:
+                self._reopen()
+            fds = [fd for fd in self._fds if fd != None]
+            if not fds:
+                self._exitNow.wait(RATE_READER_MS / 1000.0)
+                continue
+            try:
+                ready = select.select(fds, [], [], RATE_READER_MS / 1000.0)[0]
+            except select.error:
+                continue
+            for fd in ready:
+                i = self._fds.index(fd)
+                try:
+                    data = os.read(fd, EVENT_SIZE * 64)
+                except OSError:
+                    data = None
+                readUS = int(time.time() * 1000000)
+                if not data:
+                    os.close(fd)                # unplugged, reopened when the js devices change
+                    self._fds[i] = None
+                    continue
+                self._analyzer.feed(i, readUS, data)
+        self._close()
+
+    def stop(self):
+        self._exitNow.set()
+        self.join()
+
+
 ###################################################################################################
 # JOYSTICK EVENTS HANDLING
 ###################################################################################################
 class VolWiFiJoystick(object):
-    def __init__(self, dev):
+    def __init__(self, dev, remapper = None):
         self._dev = dev
+        self._remapper = remapper
         self._devs = []
         self._fds  = []
+        self._reader = None
+        self._rawReads = None
         self._js_last = []
         self._lastScanTS = 0;
+        self.firstButtonTS = None
+        self._rateEvent = RATE_EVENT_MS
+        self._rescan    = True
+        self._hud       = None
+        self._hudButton = None
+        self._observers = []
+        self.analyzer   = None
         self._event_format  = 'IhBB'
         self._event_size    = struct.calcsize(self._event_format)
 
@@ -116,6 +356,24 @@ class VolWiFiJoystick(object):
         for fd in fds:
             os.close(fd)
 
+    def _close_devices(self):
+        self._close_fds(self._fds)
+        self._fds = []
+        self._devicesChanged()
+
+    def _devicesChanged(self):
+        # only real closes / reopens are host activity that may delay reports
+        if self.analyzer != None:
+            self.analyzer.markActivity("rescan", int(round(time.time() * 1000)))
+        if self._reader != None:
+            self._reader.setDevices(self._devs if self._fds else [])
+
+    def _feed_analyzer(self):
+        # reads of a grabbed pad are timestamped by the remapper thread as they return
+        while not self._rawReads.empty():
+            (readUS, data) = self._rawReads.get()
+            self.analyzer.feed(0, readUS, data)
+
     def _read_event(self, fd):
         while True:
             try:
@@ -136,6 +394,9 @@ class VolWiFiJoystick(object):
 
         #print "type " + str(js_type) + " num " + str(js_number) + " val " + str(js_value)
 
+        if js_type == self.JS_EVENT_BUTTON and self.firstButtonTS == None:
+            self.firstButtonTS = time.time()
+
         if js_type == self.JS_EVENT_BUTTON and js_value == 1:
             if self._manager != None:
                 if js_number == 16:
@@ -145,6 +406,9 @@ class VolWiFiJoystick(object):
                 elif js_number == 19:
                     self._manager.toggleWiFi()
 
+            if self._hud != None and js_number == self._hudButton:
+                self._hud.toggle()
+
             # OSD dedicated buttons
             if osd != None:
                 if js_number == 20:
@@ -160,12 +424,63 @@ class VolWiFiJoystick(object):
 
         return True
 
+    def addObserver(self, observer):
+        """observer.onEvent(dev index, ts, js time, js type, js number, js value) sees every event read"""
+        self._observers.append(observer)
+
+    def _notify(self, i, ts, event):
+        (js_time, js_value, js_type, js_number) = struct.unpack(self._event_format, event)
+        for observer in self._observers:
+            observer.onEvent(i, ts, js_time, js_type, js_number, js_value)
+
+    def enableAnalyzer(self):
+        """Report rate analyzer mode : read the evdev reports of the pads and keep per device statistics.
+        A pad grabbed by the remapper is read through the remapper instead.
+        """
+        if self.analyzer == None:
+            self.analyzer = ReportRateAnalyzer()
+            if self._remapper != None:
+                self._rawReads = self._remapper.enableRawReads()
+            else:
+                self._reader = EvdevReader(self.analyzer)
+                self._reader.setDaemon(True)
+                self._reader.start()
+                self._reader.setDevices(self._devs if self._fds else [])
+        return self.analyzer
+
+    def close(self):
+        """Stop the analyzer reader and close the js devices"""
+        if self._reader != None:
+            self._reader.stop()
+            self._reader = None
+        self._close_fds(self._fds)
+        self._fds = []
+
+    def setHUD(self, hud, button):
+        self._hud       = hud
+        self._hudButton = button
+
+    def setRateScale(self, scale, rescan):
+        # stretch the idle polling tick and enable / pause hotplug rescans (power saving profiles)
+        self._rateEvent = RATE_EVENT_MS * scale
+        self._rescan    = rescan
+
+    def _process_remapped(self, osd):
+        # special buttons of a grabbed pad are forwarded by the uinput remapper
+        while not self._remapper.specialEvents.empty():
+            (number, value) = self._remapper.specialEvents.get()
+            self._process_event(struct.pack(self._event_format, 0, value, self.JS_EVENT_BUTTON, number), osd)
+
     def process(self, ts, osd):
-        left = RATE_EVENT_MS
+        left = self._rateEvent
+
+        if self._remapper != None:
+            self._process_remapped(osd)
 
         if not self._fds:
             self._devs, self._fds = self._open_devices()
             if self._fds:
+                self._devicesChanged()
                 i = 0
                 self._js_last = [None] * len(self._fds)
                 for js in self._fds:
@@ -177,22 +492,24 @@ class VolWiFiJoystick(object):
                 event = self._read_event(fd)
                 if event:
                     left = 0
+                    if self._observers:
+                        self._notify(i, ts, event)
                     if ts - self._js_last[i] > RATE_EVENT_MS:
                         if self._process_event(event, osd):
                             self._js_last[i] = ts
                 elif event == False:
-                    self._close_fds(self._fds)
-                    self._fds = []
+                    self._close_devices()
                     break
                 i += 1
 
+        if self._rawReads != None:
+            self._feed_analyzer()
 
         # check if new devices are attached every 2sec
-        if ts - self._lastScanTS > RATE_RESCAN_MS:
+        if self._rescan and ts - self._lastScanTS > RATE_RESCAN_MS:
             self._lastScanTS = ts
             if cmp(self._devs, self._get_devices()):
-                self._close_fds(self._fds)
-                self._fds = []
+                self._close_devices()
 
         return left
 
@@ -204,11 +521,13 @@ _isExit = threading.Event()
 def _handleSignal(signum, frame):
     _isExit.set()
 
-def _main(joyPort):
+def _main(joyPort, analyze):
     signal.signal(signal.SIGINT, _handleSignal)
     signal.signal(signal.SIGTERM, _handleSignal)
 
     joystick = VolWiFiJoystick(joyPort)
+    if analyze:
+        joystick.enableAnalyzer()
 
     do_sleep = True
     while (not _isExit.isSet()):
@@ -219,11 +538,15 @@ def _main(joyPort):
         if left > 0:
             time.sleep(left / 1000.0)
 
+    joystick.close()
+    if joystick.analyzer != None:
+        joystick.analyzer.save()
+
 if __name__ == "__main__":
     import sys
 
     try:
-        _main(sys.argv[1])
+        _main(sys.argv[1], "--analyze" in sys.argv[2:])
 
     # Catch all other non-exit errors
     except Exception as e:
@@ -5,6 +5,7 @@ sudo cp ./libraspidmx.so.1 /media/pi/EZ_WB_FS/usr/lib
 
 sudo rm -rf /opt/RCPad-Pie/
 sudo rm -f ./RCPad-Pie/*.pyc
+/usr/bin/python ./RCPad-Pie/MakeAssetPack.py
 sudo cp -f -r ./RCPad-Pie /media/pi/EZ_WB_FS/opt/
 
 sudo chmod +x /media/pi/EZ_WB_FS/opt/RCPad-Pie/pngview
@@ -5,6 +5,7 @@ sudo cp ./libraspidmx.so.1 /usr/lib
 
 sudo rm -rf /opt/RCPad-Pie/
 sudo rm -f ./RCPad-Pie/*.pyc
+/usr/bin/python ./RCPad-Pie/MakeAssetPack.py
 sudo cp -f -r ./RCPad-Pie /opt/
 
 sudo chmod +x /opt/RCPad-Pie/pngview
@@ -6,6 +6,7 @@ sudo cp ./libraspidmx.so.1 /usr/lib
 
 sudo rm -rf /opt/retropie/configs/all/RCPad-Pie/
 sudo rm -f ./RCPad-Pie/*.pyc
+/usr/bin/python ./RCPad-Pie/MakeAssetPack.py
 sudo cp -f -r ./RCPad-Pie /opt/retropie/configs/all/
 
 sudo chmod +x /opt/retropie/configs/all/RCPad-Pie/pngview